@@ -1,8 +1,10 @@
 """ This module implements base circuit layouts for all the models used"""
 import pennylane as qml
 from pennylane import numpy as np
+import jax
+import jax.numpy as jnp
 
-from typing import Tuple, List
+from typing import Tuple, List, Callable
 from numbers import Number
 
 ##############
@@ -391,3 +393,148 @@ def encoder_circuit(
         index = wall_gate(active_wires, qml.RZ, params, index=index)
 
     return index
+
+
+def _rotation(name: str, theta: List[Number]) -> List[List[List[Number]]]:
+    """
+    Batched matrices of the single-qubit rotations, shape (batch, 2, 2)
+    """
+    c, s = jnp.cos(theta / 2), jnp.sin(theta / 2)
+    zero = jnp.zeros_like(theta)
+
+    if name == "RX":
+        rows = [[c + 0j, -1j * s], [-1j * s, c + 0j]]
+    elif name == "RY":
+        rows = [[c + 0j, -s + 0j], [s + 0j, c + 0j]]
+    else:  # RZ
+        rows = [[c - 1j * s, zero + 0j], [zero + 0j, c + 1j * s]]
+
+    return jnp.stack([jnp.stack(row, axis=-1) for row in rows], axis=-2)
+
+
+# Fixed single-qubit gates supported by batched_state_circuit
+_FIXED_GATES = {
+    "Hadamard": np.array([[1, 1], [1, -1]]) / np.sqrt(2),
+    "PauliX": np.array([[0, 1], [1, 0]]),
+}
+
+
+def batched_state_circuit(
+    circuit: Callable, N: int, n_params: int, checkpoint: bool = False
+) -> Callable:
+    """
+    Build a function computing the output states of circuit for a whole batch
+    of parameters at once, as a sequence of batched einsum contractions on a
+    (batch, 2, ..., 2) state, instead of vmapping a QNode.
+    Supported gates: Hadamard, PauliX, CNOT, RX, RY, RZ, each rotation angle
+    being a distinct parameter params[i] (up to 25 qubits),
+    otherwise NotImplementedError is raised and the QNode has to be used instead.
+    Barriers split the circuit in segments (e.g. the layers of the VQE circuits)
+
+    Parameters
+    ----------
+    circuit : function
+        Circuit function circuit(params), same convention of the VQE circuits
+    N : int
+        Number of qubits
+    n_params : int
+        Number of parameters of the circuit
+    checkpoint : bool
+        if True -> Each segment is rematerialized (jax.checkpoint) in the backward pass:
+        only the states between segments are stored, instead of the state after every gate.
+        Lower memory for many qubits, at the cost of a longer compilation and backward pass
+
+    Returns
+    -------
+    function
+        Function params (batch, n_params) -> states (batch, 2**N)
+    """
+    # einsum indexes: "z" batch, one letter for each wire
+    letters = "abcdefghijklmnopqrstuvwxy"
+    if N > len(letters):
+        raise NotImplementedError(f"At most {len(letters)} qubits are supported")
+
+    # Record the circuit twice: with the parameter indexes as parameters, and with
+    # an affine map of them. A rotation angle is accepted only if it is exactly
+    # one of the parameters (no scaled, offset or fixed angles)
+    scale, offset = np.sqrt(2), np.pi / 7
+    tapes = []
+    for recorded in (np.arange(n_params), scale * np.arange(n_params) + offset):
+        with qml.tape.QuantumTape() as tape:
+            circuit(recorded)
+        tapes.append(tape.operations)
+
+    if len(tapes[0]) != len(tapes[1]):
+        raise NotImplementedError("The structure of the circuit depends on its parameters")
+
+    segments = [[]]
+    used = set()
+    for op, op_affine in zip(*tapes):
+        wires = [int(w) for w in op.wires]
+        if op.name != op_affine.name or wires != [int(w) for w in op_affine.wires]:
+            raise NotImplementedError("The structure of the circuit depends on its parameters")
+
+        if op.name == "Barrier":
+            if len(segments[-1]) > 0:
+                segments.append([])
+        elif op.name in ("RX", "RY", "RZ"):
+            angle, angle_affine = float(op.parameters[0]), float(op_affine.parameters[0])
+            index = int(round(angle))
+            if (
+                angle != index
+                or not 0 <= index < n_params
+                or index in used
+                or not np.isclose(angle_affine, scale * index + offset, rtol=0, atol=1e-9)
+            ):
+                raise NotImplementedError(
+                    f"The angle of {op.name} on wire {wires[0]} is not a single parameter"
+                )
+            used.add(index)
+            segments[-1].append((op.name, wires, index))
+        elif op.name in _FIXED_GATES or op.name == "CNOT":
+            segments[-1].append((op.name, wires, None))
+        else:
+            raise NotImplementedError(f"Gate {op.name} not supported")
+
+    state_idx = "z" + letters[:N]
+
+    def contraction(wire, batched):
+        # e.g. wire 1, batched: "zBb,zabc->zaBc"
+        gate_idx = letters[wire].upper() + letters[wire]
+        out_idx = state_idx.replace(letters[wire], letters[wire].upper())
+
+        return ("z" if batched else "") + gate_idx + "," + state_idx + "->" + out_idx
+
+    def apply_segment(ops, psi, params):
+        for name, wires, index in ops:
+            if name == "CNOT":
+                # Slice on the control axis, X (flip) on the target axis of the |1> slice
+                control, target = 1 + wires[0], 1 + wires[1]
+                psi0 = jax.lax.index_in_dim(psi, 0, control, keepdims=False)
+                psi1 = jax.lax.index_in_dim(psi, 1, control, keepdims=False)
+                psi1 = jnp.flip(psi1, axis=target - (target > control))
+                psi = jnp.stack((psi0, psi1), axis=control)
+            elif index is None:
+                gate = jnp.asarray(_FIXED_GATES[name], dtype=jnp.complex64)
+                psi = jnp.einsum(contraction(wires[0], False), gate, psi)
+            else:
+                gate = _rotation(name, params[:, index]).astype(jnp.complex64)
+                psi = jnp.einsum(contraction(wires[0], True), gate, psi)
+
+        return psi
+
+    def batched_state(params):
+        batch = params.shape[0]
+        psi = jnp.zeros((batch, 2**N), dtype=jnp.complex64).at[:, 0].set(1)
+        # Axis 1 + w of the state is wire w
+        psi = psi.reshape((batch,) + (2,) * N)
+
+        for ops in segments:
+            segment = lambda psi, params, ops=ops: apply_segment(ops, psi, params)
+            if checkpoint:
+                segment = jax.checkpoint(segment)
+            psi = segment(psi, params)
+
+        return psi.reshape(batch, 2**N)
+
+    return batched_state
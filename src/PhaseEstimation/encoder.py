@@ -85,14 +85,59 @@ class encoder:
         )
         self.wires_trash = np.setdiff1d(np.arange(self.vqe.Hs.N), self.wires)
 
-    def __repr__(self):
+        # QCircuit: Circuit(VQE, ENCparams) -> <Z> of the trash wires
+        # Built once, so repeated trainings reuse the same compilations
         @qml.qnode(self.device, interface="jax")
-        def circuit_drawer(self):
-            self.encoder_circuit_fun(np.arange(self.n_params))
+        def q_encoder_circuit(vqe_params, params):
+            self._vqe_enc_circuit(vqe_params, params)
 
             return [qml.expval(qml.PauliZ(int(k))) for k in self.wires_trash]
 
-        return qml.draw(circuit_drawer)(self)
+        v_q_encoder_circuit = jax.vmap(
+            lambda p, x: q_encoder_circuit(x, p), in_axes=(None, 0)
+        )
+
+        def compress(params, vqe_params):
+            return jnp.sum(1 - v_q_encoder_circuit(params, vqe_params)) / (
+                2 * vqe_params.shape[0]
+            )
+
+        self.j_compress = jax.jit(compress)
+        self.jd_compress = jax.jit(jax.grad(compress))
+
+        # n_steps ADAM updates as a single compiled loop (lr and n_steps are traced),
+        # returns the updated parameters and state of the optimizer and the loss
+        # on the updated parameters
+        def run_epochs(params, opt_state, vqe_params, lr, n_steps):
+            _, opt_update, get_params = optimizers.adam(lr)
+
+            def epoch(_, opt_state):
+                grads = jax.grad(compress)(get_params(opt_state), vqe_params)
+
+                return opt_update(0, grads, opt_state)
+
+            opt_state = jax.lax.fori_loop(0, n_steps, epoch, opt_state)
+            params = get_params(opt_state)
+
+            return params, opt_state, compress(params, vqe_params)
+
+        self.j_run_epochs = jax.jit(run_epochs)
+
+        # Drawing of the circuit, built on the first print
+        self._drawer = None
+
+    def __repr__(self):
+        # The circuit does not change: it is traced and drawn only once
+        if self._drawer is None:
+            @qml.qnode(self.device, interface="jax")
+            def circuit_drawer(self):
+                self.encoder_circuit_fun(np.arange(self.n_params))
+
+                return [qml.expval(qml.PauliZ(int(k))) for k in self.wires_trash]
+
+            self._drawer = qml.draw(circuit_drawer)(self)
+
+        return self._drawer
 
     def _vqe_enc_circuit(self, vqe_p: List[Number], qcnn_p: List[Number]):
         self.vqe.circuit(vqe_p)
@@ -123,44 +168,23 @@ class encoder:
         # Get the index of the training VQE states
         X_train = jnp.array(self.vqe_params0[train_index])
 
-        @qml.qnode(self.device, interface="jax")
-        def q_encoder_circuit(vqe_params, params):
-            self._vqe_enc_circuit(vqe_params, params)
-
-            return [qml.expval(qml.PauliZ(int(k))) for k in self.wires_trash]
-
-        v_q_encoder_circuit = jax.vmap(
-            lambda p, x: q_encoder_circuit(x, p), in_axes=(None, 0)
-        )
-
-        def compress(params, vqe_params):
-            return jnp.sum(1 - v_q_encoder_circuit(params, vqe_params)) / (
-                2 * len(vqe_params)
-            )
-
-        jd_compress = jax.jit(jax.grad(lambda p: compress(p, X_train)))
-        j_compress = jax.jit(lambda p: compress(p, X_train))
-
-        def update(params, opt_state):
-            grads = jd_compress(params)
-            opt_state = opt_update(0, grads, opt_state)
-
-            return get_params(opt_state), opt_state
-
         params = copy.copy(self.params)
 
         # Defining an optimizer in Jax
-        opt_init, opt_update, get_params = optimizers.adam(lr)
+        opt_init, _, get_params = optimizers.adam(lr)
         opt_state = opt_init(params)
 
         progress = tqdm.tqdm(range(n_epochs), position=0, leave=True)
-        for epoch in range(n_epochs):
-            params, opt_state = update(params, opt_state)
+        # Training loop, in chunks of 100 epochs: the progress bar (the only
+        # synchronization with the device) is updated once per chunk
+        for epoch in range(0, n_epochs, 100):
+            n_steps = min(100, n_epochs - epoch)
+            params, opt_state, loss = self.j_run_epochs(
+                params, opt_state, X_train, lr, n_steps
+            )
 
-            if (epoch + 1) % 100 == 0:
-                loss = j_compress(params)
-                progress.set_description("Cost: {0}".format(loss))
-            progress.update(1)
+            progress.update(n_steps)
+            progress.set_description("Cost: {0}".format(loss))
 
         self.params = params
 
@@ -222,15 +246,21 @@ def enc_classification_ANNNI(
 
         return [qml.expval(qml.PauliZ(int(k))) for k in encclass.wires_trash]
 
+    # Compression scores: vmap, sum over the trash wires and rescaling fused in a single
+    # jitted function, compiled once and shared by the three encoders (params is an argument)
+    j_scores = jax.jit(
+        jax.vmap(
+            lambda x, params: (1 - jnp.sum(jnp.asarray(encoder_circuit_class(x, params))) / 4) / 2,
+            in_axes=(0, None),
+        )
+    )
+
     encoding_scores = []
 
     for phase in [phase1, phase2, phase3]:
         encclass = encoder(vqeclass, encoder_circuit)
         encclass.train(lr, epochs, np.array([phase]), circuit=False)
-        v_encoder_circuit = jax.vmap(
-            lambda x: encoder_circuit_class(x, encclass.params)
-        )
-        exps = (1 - np.sum(v_encoder_circuit(X), axis=1) / 4) / 2
+        exps = np.asarray(j_scores(X, encclass.params))
         exps = np.rot90(np.reshape(exps, (sidex, sidey)))
 
         encoding_scores.append(exps)
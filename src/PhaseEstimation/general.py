@@ -3,8 +3,9 @@ import pennylane as qml
 from pennylane import numpy as np
 import jax
 import jax.numpy as jnp
+from scipy.sparse.linalg import eigsh
 
-from typing import List, Tuple, Union
+from typing import List, Tuple, Union, Callable
 from numbers import Number
 
 
@@ -103,45 +104,127 @@ def get_H_eigval_eigvec(
     return mat_H, en, psi
 
 
-def psi_outer(psi: List[Number]) -> List[List[Number]]:
-    return jnp.outer(jnp.conj(psi), psi)
+def get_H_eigval_eigvec_sparse(
+    qml_H: qml.ops.qubit.hamiltonian.Hamiltonian, en_lvl: int
+) -> Tuple[Number, List[Number]]:
+    """
+    Function for getting the energy value and state of an Ising Hamiltonian
+    through Lanczos iterations (scipy eigsh) on its sparse matrix:
+    only the lowest en_lvl + 1 eigenpairs are computed, without building
+    the dense matrix nor diagonalizing it fully
 
+    Parameters
+    ----------
+    qml_H : pennylane.ops.qubit.hamiltonian.Hamiltonian
+        Pennylane Hamiltonian of the state
+    en_lvl : int
+        Energy level desired
 
-j_psi_outer = jax.jit(psi_outer)
-jv_psi_outer = jax.jit(jax.vmap(psi_outer))
+    Returns
+    -------
+    float
+        Value of the energy level
+    np.ndarray
+        Eigenstate of the energy level
+    """
+    # This type of hamiltonians are always real
+    mat_H = qml.utils.sparse_hamiltonian(qml_H).real.tocsr()
 
+    # which="SA": smallest algebraic eigenvalues
+    eigvals, eigvecs = eigsh(mat_H, k=en_lvl + 1, which="SA")
+    order = np.argsort(eigvals)
 
-def get_VQE_params(
-    qml_H: qml.ops.qubit.hamiltonian.Hamiltonian,
-) -> Tuple[List[List[Number]], Number]:
+    en = np.single(eigvals[order[en_lvl]])
+    psi = eigvecs[:, order[en_lvl]].astype(np.single)
+
+    return en, psi
+
+
+# Codes of the single-qubit Pauli operators in a Pauli structure
+PAULI_CODES = {"Identity": 0, "PauliX": 1, "PauliY": 2, "PauliZ": 3}
+
+
+def get_pauli_terms(
+    qml_H: qml.ops.qubit.hamiltonian.Hamiltonian, N: int
+) -> Tuple[List[List[int]], List[Number]]:
     """
-    Function for getting all the training parameter for the VQE
-    algorithm
-        
+    Decompose a Pennylane Hamiltonian (sum of Pauli strings) into
+    its Pauli structures and weights, to compute expectation values
+    without building its (2**N, 2**N) matrix
+
     Parameters
     ----------
     qml_H : pennylane.ops.qubit.hamiltonian.Hamiltonian
         Pennylane Hamiltonian of the state
-        
+    N : int
+        Number of qubits
+
     Returns
     -------
     np.ndarray
-        Matricial encoding of the Hamiltonian
+        Pauli structures, shape (n_terms, N), entries in {0: I, 1: X, 2: Y, 3: Z}
+    np.ndarray
+        Weights of the terms, shape (n_terms,)
+    """
+    structures = np.zeros((len(qml_H.ops), N), dtype=int)
+
+    for k, op in enumerate(qml_H.ops):
+        # Product of Paulis (Tensor) or single Pauli
+        for obs in getattr(op, "obs", [op]):
+            structures[k, int(obs.wires[0])] = PAULI_CODES[obs.name]
+
+    return structures, np.array(qml_H.coeffs, dtype=np.single)
+
+
+def pauli_expval(
+    psi: List[Number], structures: List[List[int]], weights: List[Number]
+) -> Number:
+    """
+    Expectation value <psi|H|psi> of H = SUM_k weights_k P_k, P_k Pauli strings.
+    Each term is computed with the bit-flip/sign trick:
+    P|b> = i^(#Y) (-1)^popcount(b & zmask) |b ^ xmask>
+    O(n_terms * 2**N) operations instead of O(4**N) of the dense matrix
+
+    Parameters
+    ----------
+    psi : np.ndarray
+        State, shape (2**N,)
+    structures : np.ndarray
+        Pauli structures, see get_pauli_terms
+    weights : np.ndarray
+        Weights of the terms, see get_pauli_terms
+
+    Returns
+    -------
     float
-        Ground-state energy value
+        Expectation value
     """
+    N = structures.shape[1]
+    idx = jnp.arange(psi.shape[0], dtype=jnp.int32)
 
-    # Get the matricial for of the hamiltonian
-    # and convert it to float32
-    # This type of hamiltonians are always real
-    mat_H = np.real(qml.matrix(qml_H)).astype(np.single)
+    # Wire 0 is the most significant bit of the computational basis index
+    bits = 2 ** jnp.arange(N - 1, -1, -1, dtype=jnp.int32)
+    xmasks = jnp.sum(bits * ((structures == 1) | (structures == 2)), axis=1)
+    zmasks = jnp.sum(bits * ((structures == 2) | (structures == 3)), axis=1)
+    # Phase i^(#Y) of each term, the resulting expectation value is real
+    ny = jnp.sum(structures == 2, axis=1)
 
-    # Compute sorted eigenvalues with jitted function
-    eigvals = j_linalgeigh(mat_H)[0]
+    def term(xmask, zmask, ny):
+        signs = 1 - 2 * (jax.lax.population_count(idx & zmask) % 2)
+        overlap = jnp.sum(jnp.conj(psi[idx ^ xmask]) * signs * psi)
+        phase = jnp.array([1, 1j, -1, -1j])[ny % 4]
+
+        return jnp.real(phase * overlap)
+
+    return jnp.sum(weights * jax.vmap(term)(xmasks, zmasks, ny))
 
-    en0 = jnp.sort(eigvals)[0]
 
-    return jnp.array([mat_H]), en0
+def psi_outer(psi: List[Number]) -> List[List[Number]]:
+    return jnp.outer(jnp.conj(psi), psi)
+
+
+j_psi_outer = jax.jit(psi_outer)
+jv_psi_outer = jax.jit(jax.vmap(psi_outer))
 
 
 def get_VQD_params(
@@ -206,3 +289,54 @@ def simple_to_idx(simple: int, side: int) -> Union[int, None]:
         else:
             return side * (simple % side + 1)
     return None
+
+
+def complement_index(n: int, index: List[int]) -> np.ndarray:
+    """
+    Indexes of range(n) not in index (e.g. test set from the training set),
+    through a boolean mask instead of a sort-based set difference
+
+    Parameters
+    ----------
+    n : int
+        Size of the whole set
+    index : List[int]
+        Indexes to exclude
+
+    Returns
+    -------
+    np.ndarray
+        Sorted array of the remaining indexes
+    """
+    # As a set difference, indexes outside range(n) are ignored
+    index = np.asarray(index, dtype=int)
+    mask = np.ones(n, dtype=bool)
+    mask[index[(index >= 0) & (index < n)]] = False
+
+    return np.nonzero(mask)[0]
+
+
+def chunked_map(fun: Callable, X: List[Number], chunk_size: int = 4096) -> np.ndarray:
+    """
+    Evaluate a batched function on consecutive chunks of X and concatenate the outputs on the host.
+    Peak device memory scales with chunk_size instead of len(X); at most two shapes
+    (full chunk and remainder) are compiled
+
+    Parameters
+    ----------
+    fun : function
+        Batched function fun(X_chunk) -> array with leading dimension len(X_chunk)
+    X : np.ndarray
+        Inputs, batched over the first axis
+    chunk_size : int
+        Number of inputs evaluated at once
+
+    Returns
+    -------
+    np.ndarray
+        Concatenation of fun over all the chunks
+    """
+    # An empty X is still passed to fun once, the output keeps its trailing shape
+    outs = [np.asarray(fun(X[i : i + chunk_size])) for i in range(0, max(len(X), 1), chunk_size)]
+
+    return np.concatenate(outs)
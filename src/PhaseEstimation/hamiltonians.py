@@ -24,6 +24,8 @@ class hamiltonian:
             Arguments of the building_func function
         """
         self.func = building_func
+        # Kept to rebuild the class when loading a saved VQE
+        self._kwargs = kwargs
 
         # Set the kwargs to attributes
         for key, value in kwargs.items():
@@ -74,6 +76,8 @@ class hamiltonian:
             if True plots the phase transition lines
         pe_line : bool
             if True plots Peshel Emery line
+        reuse_figure : bool
+            if True and the figure is still open, only its data is updated
         """
         if self.func == annni.build_Hs:
             self.add_true()
@@ -93,7 +97,8 @@ class hamiltonian:
 
 def get_e_psi(Hclass, en_lvl):
     """
-    Return respectively the list of the true energies and true states obtained through the diagonalization of the hamiltonian matrices
+    Return respectively the list of the true energies and true states obtained through the diagonalization
+    of the (sparse) hamiltonian matrices
 
     Parameters
     ----------
@@ -112,7 +117,7 @@ def get_e_psi(Hclass, en_lvl):
     e_list   = []
     psi_list = []
     for H in tqdm(Hclass.qml_Hs):
-        _, e, psi = qmlgen.get_H_eigval_eigvec(H, en_lvl)
+        e, psi = qmlgen.get_H_eigval_eigvec_sparse(H, en_lvl)
         e_list.append(e), psi_list.append(psi)
 
     return np.array(e_list), np.array(psi_list)
@@ -1,12 +1,130 @@
-""" This module implements loss functions and regularizers for VQE, QCNN and Encoder"""
+""" This module implements loss functions and regularizers for VQE, QCNN and Encoder
+
+Every loss is jitted with the quantum circuit as a static argument: the first call
+for a given (circuit, shapes, dtypes) signature pays the tracing and XLA compilation
+cost, the following calls (e.g. each step of the optimizer) reuse the compiled kernel.
+"""
 import jax
 import jax.numpy as jnp
 
-from typing import List, Callable
+from functools import partial
+from typing import List, Callable, Optional, Tuple
 from numbers import Number
 
+# Precision of the statevector algebra in the losses, single precision
+# is enough for fidelities and halves the memory traffic of complex128
+LOSS_DTYPE = jnp.complex64
+
+
+def pad_to_bucket(X: List[Number], bucket: int = 64) -> Tuple[List[Number], int]:
+    """
+    Pad the first axis of X with zeros up to the next multiple of bucket.
+    Batches of different sizes falling in the same bucket share the same
+    shape, hence the same compiled loss. Pass the returned number of samples
+    as n_valid to the losses so that the padded samples are ignored in the mean
+    (for vqe_fidelities just discard the last entries of the output)
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Array to pad (inputs or labels)
+    bucket : int
+        Size of the bucket
+
+    Returns
+    -------
+    np.ndarray
+        Padded array
+    int
+        Number of original (valid) samples
+    """
+    n = X.shape[0]
+    pad_n = (-n) % bucket
+
+    return jnp.pad(X, ((0, pad_n),) + ((0, 0),) * (X.ndim - 1)), n
+
+
+def _masked_mean(values: List[Number], n_valid: Optional[int] = None) -> float:
+    """
+    Mean of values (first axis = samples) over the first n_valid samples only,
+    n_valid is traced so different values do not trigger recompilations
+    """
+    if n_valid is None:
+        return jnp.mean(values)
+
+    mask = jnp.arange(values.shape[0]) < n_valid
+    mask = mask.reshape((-1,) + (1,) * (values.ndim - 1))
+
+    return jnp.sum(jnp.where(mask, values, 0)) / (n_valid * (values.size // values.shape[0]))
+
+
+def _map_samples(fun: Callable, X: List[Number], batch_strategy: str = "vmap") -> List[Number]:
+    """
+    Apply fun to every sample (first axis) of X
+
+    Parameters
+    ----------
+    fun : fun
+        Function of a single sample
+    X : np.ndarray
+        Array of samples
+    batch_strategy : str
+        "vmap"   -> all the samples are evaluated in parallel (fast, memory grows with the batch)
+        "serial" -> jax.lax.map, one sample at a time (same compiled kernel, memory of a single sample)
+
+    Returns
+    -------
+    np.ndarray
+        Stacked outputs
+    """
+    if batch_strategy == "vmap":
+        return jax.vmap(fun)(X)
+    elif batch_strategy == "serial":
+        return jax.lax.map(fun, X)
+
+    raise ValueError("Invalid batch_strategy, it can only be either 'vmap' or 'serial'")
+
+
+def quantize_states(Y: List[Number], precision: type = jnp.bfloat16) -> List[Number]:
+    """
+    Store an array of (target) states in low precision as real/imaginary pairs.
+    Targets are read at every evaluation of the fidelities, keeping them in
+    bfloat16 halves (complex64) or quarters (complex128) the memory they occupy
+    and the bytes moved by the reduction. Use with vqe_fidelities(..., target_precision=precision)
+
+    Parameters
+    ----------
+    Y : np.ndarray
+        Array of states, shape (n_states, 2**N)
+    precision : type
+        Real dtype of the stored parts
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n_states, 2**N, 2): real and imaginary parts
+    """
+    Y = jnp.asarray(Y)
+
+    return jnp.stack((jnp.real(Y), jnp.imag(Y)), axis=-1).astype(precision)
+
+
 # VQE LOSSES
-def vqe_fidelities(Y: List[Number], params: List[Number], q_circuit: Callable) -> float:
+@partial(
+    jax.jit,
+    static_argnames=(
+        "q_circuit", "q_circuit_batched", "dtype", "batch_strategy", "target_precision"
+    ),
+)
+def vqe_fidelities(
+    Y: List[Number],
+    params: List[Number],
+    q_circuit: Callable,
+    q_circuit_batched: Optional[Callable] = None,
+    dtype: type = LOSS_DTYPE,
+    batch_strategy: str = "vmap",
+    target_precision: Optional[type] = None,
+) -> float:
     """
     LOSS: Compute Fidelity between VQE PSI (output of q_circuit(params)) and TRUE PSI computed by diagonalizing the Hamiltonian
     
@@ -18,6 +136,18 @@ def vqe_fidelities(Y: List[Number], params: List[Number], q_circuit: Callable) -
         Array of parameters of the VQE circuits
     q_circuit : fun
         Quantum function of the VQE circuit
+    q_circuit_batched : fun
+        (Optional) Quantum function of the VQE circuit taking the whole array of
+        parameters and returning the array of states, if passed it is used instead
+        of vectorizing q_circuit
+    dtype : type
+        Complex dtype in which the inner products are computed
+    batch_strategy : str
+        How q_circuit is mapped over params: "vmap" (parallel) or "serial" (jax.lax.map,
+        for large number of qubits where the whole batch of states does not fit in memory)
+    target_precision : type
+        (Optional) if the targets Y were stored with quantize_states, their precision;
+        they are upcast to dtype inside the reduction
         
     Returns
     -------
@@ -25,20 +155,54 @@ def vqe_fidelities(Y: List[Number], params: List[Number], q_circuit: Callable) -
         Mean fidelities between VQE PSI and TRUE PSI
     """
 
-    # Core function, not vectorized
-    def vqe_fidelity(y, p, q_circuit):
-        psi_out = q_circuit(p)
+    # Output states of the VQE circuit for every set of parameters
+    if q_circuit_batched is not None:
+        psi_out = q_circuit_batched(params)
+    else:
+        psi_out = _map_samples(q_circuit, params, batch_strategy)
 
-        return jnp.square(jnp.abs(jnp.conj(psi_out) @ y))
+    if target_precision is not None:
+        # Upcast the quantized real/imaginary pairs
+        real_dtype = jnp.finfo(dtype).dtype
+        Y = jax.lax.complex(Y[..., 0].astype(real_dtype), Y[..., 1].astype(real_dtype))
 
-    # Vectorize the fidelity function
-    v_fidelty = jax.vmap(lambda y, p: vqe_fidelity(y, p, q_circuit), in_axes=(0, 0))
+    psi_out, Y = psi_out.astype(dtype), Y.astype(dtype)
 
-    return v_fidelty(Y, params)
+    # All the inner products <psi_out|y> in a single batched reduction
+    inner = jnp.einsum("bi,bi->b", jnp.conj(psi_out), Y)
+
+    # |<psi_out|y>|^2 as re^2 + im^2, avoiding the sqrt of jnp.abs
+    return jnp.square(inner.real) + jnp.square(inner.imag)
 
 
 # QCNN LOSSES
-def hinge(X, Y, params, q_circuit):
+def _v_qcnn_prob(q_circuit: Callable, batch_strategy: str = "vmap") -> Callable:
+    """
+    Vectorize q_circuit(x, params) over the inputs x only.
+    It is traced inside the jitted QCNN losses (the circuit being their static argument),
+    so no separate compilation is needed; outside the losses qcnn.jv_qcnn_circuit_prob
+    is the compiled forward pass
+
+    Parameters
+    ----------
+    q_circuit : fun
+        Quantum function of the QCNN circuit
+    batch_strategy : str
+        "vmap" or "serial", see _map_samples
+
+    Returns
+    -------
+    fun
+        Vectorized circuit v_q_circuit(X, params)
+    """
+    if batch_strategy == "vmap":
+        return jax.vmap(q_circuit, in_axes=(0, None))
+
+    return lambda X, params: _map_samples(lambda x: q_circuit(x, params), X, batch_strategy)
+
+
+@partial(jax.jit, static_argnums=(3,), static_argnames=("batch_strategy",))
+def hinge(X, Y, params, q_circuit, n_valid=None, batch_strategy="vmap"):
     """
     LOSS: (Experimental) Compute Hinge loss for a binary classification task
     N.B: MAX is not applied because output is a probability [0,1] that will be mapped
@@ -54,23 +218,31 @@ def hinge(X, Y, params, q_circuit):
         Array of parameters of the QCNN circuit
     q_circuit : fun
         Quantum function of the VQE circuit
+    n_valid : int
+        (Optional) Number of valid samples if the batch was padded with pad_to_bucket
+    batch_strategy : str
+        How the circuit is mapped over X: "vmap" (parallel) or "serial" (jax.lax.map, bounded memory)
         
     Returns
     -------
     float
         Mean Hinge Loss <Circuit(X)|Y>
     """
-    v_qcnn_prob = jax.vmap(lambda v: q_circuit(v, params))
+    # Only the probability of the label 1 is needed
+    p1 = _v_qcnn_prob(q_circuit, batch_strategy)(X, params)[:, 1]
+    Y = Y.astype(p1.dtype)
 
-    predictions = 2 * v_qcnn_prob(X) - 1
-    Y_hinge = 2 * Y - 1
-
-    hinge_loss = jnp.mean(1 - predictions[:, 1] * Y_hinge)
+    # 1 - (2*p1 - 1)*(2*Y - 1) expanded, avoiding the rescaled copies
+    # of predictions and labels
+    hinge_loss = _masked_mean(2 * p1 + 2 * Y - 4 * p1 * Y, n_valid)
 
     return hinge_loss
 
 
-def cross_entropy1D(X, Y, params, q_circuit):
+@partial(jax.jit, static_argnums=(3,), static_argnames=("batch_strategy", "log_predictions"))
+def cross_entropy1D(
+    X, Y, params, q_circuit, n_valid=None, batch_strategy="vmap", log_predictions=False
+):
     """
     LOSS: Compute Cross Entropy for a binary classification task
     
@@ -79,29 +251,41 @@ def cross_entropy1D(X, Y, params, q_circuit):
     X : np.ndarray
         Array of VQE parameters (input of VQE)
     Y : np.ndarray
-        Array of labels
+        Array of labels (pass them already as int32, a different dtype triggers a recompilation)
     params : np.ndarray
         Array of parameters of the QCNN circuit
     q_circuit : fun
         Quantum function of the VQE circuit
+    n_valid : int
+        (Optional) Number of valid samples if the batch was padded with pad_to_bucket
+    batch_strategy : str
+        How the circuit is mapped over X: "vmap" (parallel) or "serial" (jax.lax.map, bounded memory)
+    log_predictions : bool
+        if True -> q_circuit already outputs log-probabilities and no log is taken
         
     Returns
     -------
     float
         Cross entropy <Circuit(X)|Y>
     """
-    v_qcnn_prob = jax.vmap(lambda v: q_circuit(v, params))
-
-    predictions = v_qcnn_prob(X)
-    logprobs = jnp.log(predictions)
+    predictions = _v_qcnn_prob(q_circuit, batch_strategy)(X, params)
 
-    nll = jnp.take_along_axis(logprobs, jnp.expand_dims(Y, axis=1), axis=1)
-    ce = -jnp.mean(nll)
+    # Labels are used as indexes, they need to be integers
+    Y = jnp.asarray(Y, dtype=jnp.int32).reshape(-1)
+    # Gather the probability of the correct label for each sample first,
+    # the log is then computed only on those (clipped to avoid log(0))
+    probs = jnp.take_along_axis(predictions, Y[:, None], axis=1).squeeze(1)
+    if log_predictions:
+        nll = probs
+    else:
+        nll = jnp.log(jnp.clip(probs, 1e-12, 1.0))
+    ce = -_masked_mean(nll, n_valid)
 
     return ce
 
 
-def cross_entropy(X, Y, params, q_circuit):
+@partial(jax.jit, static_argnums=(3,), static_argnames=("batch_strategy", "power"))
+def cross_entropy(X, Y, params, q_circuit, n_valid=None, batch_strategy="vmap", power=1):
     """
     LOSS: Compute Cross Entropy for a binary classification task
     
@@ -110,57 +294,35 @@ def cross_entropy(X, Y, params, q_circuit):
     X : np.ndarray
         Array of VQE parameters (input of VQE)
     Y : np.ndarray
-        Array of labels
+        Array of binary labels (pass them already as int32, a different dtype triggers a recompilation)
     params : np.ndarray
         Array of parameters of the QCNN circuit
     q_circuit : function
         Quantum function of the VQE circuit
+    n_valid : int
+        (Optional) Number of valid samples if the batch was padded with pad_to_bucket
+    batch_strategy : str
+        How the circuit is mapped over X: "vmap" (parallel) or "serial" (jax.lax.map, bounded memory)
+    power : int
+        Power applied to the log-probabilities (static, every value is compiled once)
         
     Returns
     -------
     float
         Cross entropy <Circuit(X)|Y>
     """
-    v_qcnn_prob = jax.vmap(lambda v: q_circuit(v, params))
-
-    predictions = v_qcnn_prob(X)
-    logprobs1 = jnp.log(predictions).flatten()
-    logprobs2 = jnp.log(1 - predictions).flatten()
-    logprobs1 = logprobs1
-    logprobs2 = logprobs2
-    Y = Y.flatten()
+    predictions = _v_qcnn_prob(q_circuit, batch_strategy)(X, params).flatten()
+    Y = jnp.asarray(Y, dtype=jnp.int32).reshape(-1)
 
-    return +jnp.mean(Y * logprobs1 + (1 - Y) * logprobs2)
+    # Labels are binary: for each entry only log(p) (Y = 1) or log(1 - p) (Y = 0)
+    # is needed, select the probability first and take a single log
+    probs = jnp.where(Y == 1, predictions, 1 - predictions)
+    logprobs = jnp.log(jnp.clip(probs, 1e-12, 1.0))
+    if power != 1:
+        logprobs = jnp.power(logprobs, power)
 
+    return +_masked_mean(logprobs.reshape(X.shape[0], -1), n_valid)
 
-def cross_entropy_power4(X, Y, params, q_circuit):
-    """
-    LOSS: Compute Cross Entropy for a binary classification task
-    Apply ^4 to punish the model on uncertain classifications
-
-    Parameters
-    ----------
-    X : np.ndarray
-        Array of VQE parameters (input of VQE)
-    Y : np.ndarray
-        Array of labels
-    params : np.ndarray
-        Array of parameters of the QCNN circuit
-    q_circuit : function
-        Quantum function of the VQE circuit
-        
-    Returns
-    -------
-    float
-        Cross entropy <Circuit(X)|Y>
-    """
-    v_qcnn_prob = jax.vmap(lambda v: q_circuit(v, params))
-
-    predictions = v_qcnn_prob(X)
-    logprobs1 = jnp.log(predictions).flatten()
-    logprobs2 = jnp.log(1 - predictions).flatten()
-    logprobs1 = jnp.square(jnp.square(logprobs1))
-    logprobs2 = jnp.square(jnp.square(logprobs2))
-    Y = Y.flatten()
 
-    return +jnp.mean(Y * logprobs1 + (1 - Y) * logprobs2)
+# LOSS: Cross Entropy with ^4 applied to punish the model on uncertain classifications
+cross_entropy_power4 = partial(cross_entropy, power=4)
@@ -96,16 +96,38 @@ class qcnn:
         self.loss_train: List[float] = []
         self.loss_test: List[float] = []
 
-    def __repr__(self):
+        # QCircuit: Circuit(VQE, QCNNparams) -> probs
+        # Built once: the losses are jitted with the circuit as a static argument,
+        # so repeated trainings and predictions reuse the same compilations
         @qml.qnode(self.device, interface="jax")
-        def circuit_drawer(self):
-            _ = self.qcnn_circuit_fun(np.arange(self.n_params))
-            if self.n_outputs == 1:
-                return qml.probs(wires=self.N - 1)
-            else:
-                return qml.probs([int(k) for k in self.final_active_wires])
+        def qcnn_circuit_prob(vqe_p, qcnn_p):
+            self._vqe_qcnn_circuit(vqe_p, qcnn_p)
+
+            return qml.probs([int(k) for k in self.final_active_wires])
 
-        return qml.draw(circuit_drawer)(self)
+        self.qcnn_circuit_prob = qcnn_circuit_prob
+        self.jv_qcnn_circuit_prob = jax.jit(
+            jax.vmap(qcnn_circuit_prob, in_axes=(0, None))
+        )  # jitted vmap of the circuit over the VQE states
+        # Jitted (loss and gradient, loss) for each loss function used in training
+        self._loss_fns = {}
+        # Drawing of the circuit, built on the first print
+        self._drawer = None
+
+    def __repr__(self):
+        # The circuit does not change: it is traced and drawn only once
+        if self._drawer is None:
+            @qml.qnode(self.device, interface="jax")
+            def circuit_drawer(self):
+                _ = self.qcnn_circuit_fun(np.arange(self.n_params))
+                if self.n_outputs == 1:
+                    return qml.probs(wires=self.N - 1)
+                else:
+                    return qml.probs([int(k) for k in self.final_active_wires])
+
+            self._drawer = qml.draw(circuit_drawer)(self)
+
+        return self._drawer
 
     def _vqe_qcnn_circuit(self, vqe_p, qcnn_p):
         """
@@ -147,14 +169,16 @@ class qcnn:
         # -1 could be in the labels as [-1, -1] when training
         # ANNNI model which non-trivial cases have no solution
         if (-1 not in self.labels) and (None not in self.labels):
+            # Labels are cast to int32 once here, so the jitted losses
+            # always see the same dtype and are not recompiled
             X_train, Y_train = (
                 jnp.array(self.vqe_params[train_index]),
-                jnp.array(self.labels[train_index]),
+                jnp.array(self.labels[train_index], dtype=jnp.int32),
             )
-            test_index = np.setdiff1d(np.arange(len(self.vqe_params)), train_index)
+            test_index = qmlgen.complement_index(len(self.vqe_params), train_index)
             X_test, Y_test = (
                 jnp.array(self.vqe_params[test_index]),
-                jnp.array(self.labels[test_index]),
+                jnp.array(self.labels[test_index], dtype=jnp.int32),
             )
         else:
             # If we are traing an ANNNI model, we have to first restrict on the trivial cases:
@@ -194,11 +218,11 @@ class qcnn:
                     Ymix.append([0, 0, 1, 0])  # Antiphase
                 elif (label == [1, 1]).all():
                     Ymix.append([0, 0, 0, 1])  # Paramagnetic
-            Y = jnp.array(Ymix)
+            Y = jnp.array(Ymix, dtype=jnp.int32)
 
             # The indexes of test are
             # All indexes (only analitical) \ train_index
-            test_index = np.setdiff1d(np.arange(len(Y)), train_index)
+            test_index = qmlgen.complement_index(len(Y), train_index)
 
             X_train, Y_train = X[train_index], Y[train_index]
             X_test, Y_test = X[test_index], Y[test_index]
@@ -208,56 +232,72 @@ class qcnn:
             print("+--- CIRCUIT ---+")
             print(self)
 
-        # QCircuit: Circuit(VQE, QCNNparams) -> probs
-        @qml.qnode(self.device, interface="jax")
-        def qcnn_circuit_prob(vqe_p, qcnn_p):
-            self._vqe_qcnn_circuit(vqe_p, qcnn_p)
-
-            return qml.probs([int(k) for k in self.final_active_wires])
-
         params = copy.copy(self.params)
 
-        # Gradient of the Loss function
-        jd_loss_fn = jax.jit(
-            jax.grad(lambda p: loss_fn(X_train, Y_train, p, qcnn_circuit_prob))
-        )
+        # Chunk of epochs compiled as a single loop and the loss function alone
+        # for the test set (built once for each loss_fn)
+        if loss_fn not in self._loss_fns:
+            loss_circuit = lambda X, Y, p: loss_fn(X, Y, p, self.qcnn_circuit_prob)
+            vd_loss_fn = jax.value_and_grad(loss_circuit, argnums=2)
+
+            # n_steps ADAM updates on device: returns the updated parameters and
+            # state of the optimizer, the parameters after the first update and
+            # the training loss evaluated on them (for logging, as the per-epoch loop did)
+            def run_epochs(X, Y, params, opt_state, lr, n_steps):
+                _, opt_update, get_params = optimizers.adam(lr)
+
+                grads = vd_loss_fn(X, Y, params)[1]
+                opt_state = opt_update(0, grads, opt_state)
+                params_log = get_params(opt_state)
+
+                def epoch(i, carry):
+                    opt_state, loss = carry
+                    value, grads = vd_loss_fn(X, Y, get_params(opt_state))
+                    # The first step of the loop starts from params_log:
+                    # its loss comes with the gradient
+                    loss = jnp.where(i == 1, value, loss)
+
+                    return opt_update(0, grads, opt_state), loss
+
+                opt_state, loss = jax.lax.fori_loop(
+                    1, n_steps, epoch, (opt_state, jnp.zeros(()))
+                )
+                # A single step has no loop, the loss is evaluated on its own
+                loss = jax.lax.cond(
+                    n_steps > 1, lambda: loss, lambda: loss_circuit(X, Y, params_log)
+                )
 
-        # Update function
-        # Returns updated parameters, updated state of the optimizer
-        def update(params, opt_state):
-            grads = jd_loss_fn(params)
-            opt_state = opt_update(0, grads, opt_state)
+                return get_params(opt_state), opt_state, loss, params_log
 
-            return get_params(opt_state), opt_state
+            self._loss_fns[loss_fn] = (jax.jit(run_epochs), jax.jit(loss_circuit))
+        j_run_epochs, j_loss_fn = self._loss_fns[loss_fn]
 
-        # Definying following function:
-        # jitted loss function for training set loss(params)
-        train_loss_fn = jax.jit(
-            lambda p: loss_fn(X_train, Y_train, p, qcnn_circuit_prob)
-        )
         # jitted loss function for test set loss(params)
-        test_loss_fn = jax.jit(lambda p: loss_fn(X_test, Y_test, p, qcnn_circuit_prob))
+        test_loss_fn = lambda p: j_loss_fn(X_test, Y_test, p)
 
         # Initialize tqdm progress bar
         progress = tqdm.tqdm(range(n_epochs), position=0, leave=True)
 
         # Defining an optimizer in Jax
-        opt_init, opt_update, get_params = optimizers.adam(lr)
+        opt_init, _, get_params = optimizers.adam(lr)
         opt_state = opt_init(params)
 
         loss_history, loss_history_test = [], []
-        # Training loop:
-        for epoch in range(n_epochs):
-            params, opt_state = update(params, opt_state)
+        # Training loop, in chunks of 100 epochs:
+        # the host only intervenes once per chunk
+        for epoch in range(0, n_epochs, 100):
+            n_steps = min(100, n_epochs - epoch)
+            params, opt_state, loss, params_log = j_run_epochs(
+                X_train, Y_train, params, opt_state, lr, n_steps
+            )
 
             # Every 100 iterations append the updated training (and testing) loss
-            if epoch % 100 == 0:
-                loss_history.append(train_loss_fn(params))
-                if len(Y_test) > 0:
-                    loss_history_test.append(test_loss_fn(params))
+            loss_history.append(loss)
+            if len(Y_test) > 0:
+                loss_history_test.append(test_loss_fn(params_log))
 
             # Update progress bar
-            progress.update(1)
+            progress.update(n_steps)
             progress.set_description("Cost: {0}".format(loss_history[-1]))
 
         # Update qcnn class after training
@@ -285,26 +325,23 @@ class qcnn:
             plt.grid(True)
             plt.legend()
 
-    def predict(self):
+    def predict(self, chunk_size: int = 4096):
         """
         Get the phases probabilities for each VQE state
 
+        Parameters
+        ----------
+        chunk_size : int
+            Number of states evaluated at once, bounds the memory of the predictions
+
         Returns
         -------
         List[List[Number]]
             List of probabilities
         """
-        @qml.qnode(self.device, interface="jax")
-        def qcnn_circuit_prob(params_vqe, params):
-            self._vqe_qcnn_circuit(params_vqe, params)
-
-            return qml.probs([int(k) for k in self.final_active_wires])
-
-        vcircuit = jax.vmap(
-            lambda v: qcnn_circuit_prob(v, self.params), in_axes=(0)
-        )
+        vcircuit = lambda X: self.jv_qcnn_circuit_prob(X, self.params)
 
-        predictions = np.array(vcircuit(self.vqe_params))
+        predictions = np.array(qmlgen.chunked_map(vcircuit, self.vqe_params, chunk_size))
 
         return predictions
 
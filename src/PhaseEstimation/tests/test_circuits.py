@@ -0,0 +1,97 @@
+"""Test the batched simulation of the VQE circuits against the QNode."""
+import numpy as np
+import pennylane as qml
+import jax
+import jax.numpy as jnp
+import pytest
+
+from PhaseEstimation import circuits, vqe, hamiltonians
+from PhaseEstimation import ising_chain as ising
+
+N = 4
+
+
+def _qnode_states(circuit, params):
+    device = qml.device("default.qubit.jax", wires=N, shots=None)
+
+    @qml.qnode(device, interface="jax")
+    def q_state(p):
+        circuit(p)
+
+        return qml.state()
+
+    return jax.vmap(q_state)(params)
+
+
+def _random_params(n_params, batch=3):
+    return jax.random.uniform(jax.random.PRNGKey(0), (batch, n_params), minval=-np.pi, maxval=np.pi)
+
+
+@pytest.mark.parametrize("vqe_circuit", [vqe.circuit_ising, vqe.circuit_ising2, vqe.circuit_ising3])
+@pytest.mark.parametrize("checkpoint", [False, True])
+def test_batched_state_circuit(vqe_circuit, checkpoint):
+    circuit = lambda p: vqe_circuit(N, p)
+    n_params = circuit([0] * 10000)
+    params = _random_params(n_params)
+
+    batched = circuits.batched_state_circuit(circuit, N, n_params, checkpoint=checkpoint)
+    np.testing.assert_allclose(batched(params), _qnode_states(circuit, params), atol=1e-5)
+
+    # Gradients of a real function of the states
+    target = _qnode_states(circuit, params[::-1])
+    loss = lambda states: lambda p: jnp.sum(jnp.abs(jnp.sum(jnp.conj(target) * states(p), axis=1)) ** 2)
+    np.testing.assert_allclose(
+        jax.grad(loss(batched))(params),
+        jax.grad(loss(lambda p: _qnode_states(circuit, p)))(params),
+        atol=1e-4,
+    )
+
+
+def _scaled(N, params):
+    qml.RY(2 * params[0], wires=0)
+    qml.RX(params[1], wires=1)
+
+    return 2
+
+
+def _fixed(N, params):
+    qml.RY(np.pi / 2, wires=0)
+    qml.RX(params[0], wires=1)
+
+    return 1
+
+
+def _shared(N, params):
+    qml.RY(params[0], wires=0)
+    qml.RY(params[0], wires=1)
+
+    return 1
+
+
+def _unsupported(N, params):
+    qml.RY(params[0], wires=0)
+    qml.CZ(wires=[0, 1])
+
+    return 1
+
+
+@pytest.mark.parametrize("vqe_circuit", [_scaled, _fixed, _shared, _unsupported])
+def test_fallback(vqe_circuit):
+    circuit = lambda p: vqe_circuit(N, p)
+    n_params = circuit([0] * 10000)
+
+    with pytest.raises(NotImplementedError):
+        circuits.batched_state_circuit(circuit, N, n_params)
+
+    # The VQE class falls back to the QNode
+    Hs = hamiltonians.hamiltonian(ising.build_Hs, N=N, J=1, n_states=2)
+    vqeclass = vqe.vqe(Hs, vqe_circuit, seed=0)
+    params = _random_params(n_params)
+    np.testing.assert_allclose(
+        vqeclass.v_q_vqe_state(params), _qnode_states(circuit, params), atol=1e-5
+    )
+
+
+if __name__ == "__main__":
+    test_batched_state_circuit(vqe.circuit_ising, False)
+    test_fallback(_scaled)
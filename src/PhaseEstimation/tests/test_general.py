@@ -0,0 +1,60 @@
+"""Test the generic functions of the general module."""
+import numpy as np
+import pennylane as qml
+import jax
+import jax.numpy as jnp
+import pytest
+
+from PhaseEstimation import general as qmlgen, hamiltonians
+from PhaseEstimation import ising_chain as ising, annni_model as annni
+
+
+@pytest.mark.parametrize(
+    "build_Hs, kwargs",
+    [
+        (ising.build_Hs, dict(N=4, J=1, n_states=3)),
+        (annni.build_Hs, dict(N=4, n_hs=2, n_kappas=2)),
+    ],
+)
+def test_pauli_expval(build_Hs, kwargs):
+    Hs = hamiltonians.hamiltonian(build_Hs, **kwargs)
+    rng = np.random.default_rng(0)
+
+    for qml_H in Hs.qml_Hs:
+        structures, weights = qmlgen.get_pauli_terms(qml_H, Hs.N)
+        mat_H = qml.matrix(qml_H, wire_order=range(Hs.N))
+
+        psi = rng.normal(size=2**Hs.N) + 1j * rng.normal(size=2**Hs.N)
+        psi = (psi / np.linalg.norm(psi)).astype(np.complex64)
+
+        expected = np.real(np.conj(psi) @ mat_H @ psi)
+        expval = qmlgen.pauli_expval(jnp.array(psi), jnp.array(structures), jnp.array(weights))
+        np.testing.assert_allclose(expval, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_complement_index():
+    # Same result as the set difference, duplicates and out-of-range indexes included
+    index = [3, 1, 3, -1, 7, 12]
+    np.testing.assert_array_equal(
+        qmlgen.complement_index(8, index), np.setdiff1d(np.arange(8), index)
+    )
+    np.testing.assert_array_equal(qmlgen.complement_index(4, []), np.arange(4))
+    assert len(qmlgen.complement_index(3, [0, 1, 2, 2])) == 0
+
+
+def test_chunked_map():
+    fun = jax.jit(lambda X: jnp.stack((X.sum(axis=1), X.max(axis=1)), axis=1))
+    X = np.random.default_rng(0).normal(size=(10, 3)).astype(np.float32)
+
+    # 10 = 2 full chunks of 4 and a remainder of 2
+    out = qmlgen.chunked_map(fun, X, chunk_size=4)
+    np.testing.assert_allclose(out, fun(X), rtol=1e-6)
+
+    # Empty input: empty output with the trailing shape of fun
+    assert qmlgen.chunked_map(fun, X[:0], chunk_size=4).shape == (0, 2)
+
+
+if __name__ == "__main__":
+    test_pauli_expval(ising.build_Hs, dict(N=4, J=1, n_states=3))
+    test_complement_index()
+    test_chunked_map()
@@ -0,0 +1,23 @@
+"""Test the helpers of the plotting module."""
+import numpy as np
+import pytest
+
+
+def test_fidelity_matrix_numba():
+    pytest.importorskip("numba")
+    from PhaseEstimation import visualization as qplt
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(10, 16)) + 1j * rng.normal(size=(10, 16))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # Matmul path
+    G = np.conj(vectors) @ vectors.T
+    expected = np.abs(G) ** 2
+
+    assert len(vectors) <= qplt._NUMBA_MAX_STATES
+    np.testing.assert_allclose(qplt._fidelity_matrix(vectors), expected, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_fidelity_matrix_numba()
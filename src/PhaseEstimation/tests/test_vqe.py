@@ -0,0 +1,61 @@
+"""Test saving and loading the VQE class."""
+import pathlib
+import pickle
+import tempfile
+
+import numpy as np
+
+from PhaseEstimation import vqe, hamiltonians
+from PhaseEstimation import ising_chain as ising
+
+
+def _trained_vqe():
+    Hs = hamiltonians.hamiltonian(ising.build_Hs, N=4, J=1, n_states=3)
+    Hs.true_e0 = np.array([-4.0, -3.5, -3.0], dtype=np.single)
+    vqeclass = vqe.vqe(Hs, vqe.circuit_ising, seed=0)
+    vqeclass.vqe_params0 = np.asarray(vqeclass.vqe_params0)
+    vqeclass.vqe_e0 = np.array([-3.9, -3.4, -2.9])
+    vqeclass.true_e0 = np.zeros(3, dtype=np.single)
+
+    return vqeclass
+
+
+def _assert_same(loaded, saved):
+    assert loaded.circuit_fun is saved.circuit_fun
+    assert loaded.Hs.func is saved.Hs.func
+    assert loaded.Hs.N == saved.Hs.N and loaded.Hs.n_states == saved.Hs.n_states
+    np.testing.assert_allclose(loaded.Hs.true_e0, saved.Hs.true_e0)
+    np.testing.assert_allclose(loaded.vqe_params0, saved.vqe_params0)
+    np.testing.assert_allclose(loaded.vqe_e0, saved.vqe_e0)
+    np.testing.assert_allclose(loaded.true_e0, saved.true_e0)
+
+
+def test_save_load(tmp_path, monkeypatch):
+    saved = _trained_vqe()
+    filename = str(tmp_path / "vqe.npz")
+    saved.save(filename)
+
+    # Circuits and Hamiltonians of the package are loaded without pickle
+    def no_pickle(*args, **kwargs):
+        raise AssertionError("pickle used")
+
+    monkeypatch.setattr(vqe.pickle, "loads", no_pickle)
+    monkeypatch.setattr(vqe.pickle, "load", no_pickle)
+
+    _assert_same(vqe.load_vqe(filename), saved)
+
+
+def test_load_legacy(tmp_path):
+    saved = _trained_vqe()
+    filename = str(tmp_path / "vqe.pkl")
+    with open(filename, "wb") as f:
+        pickle.dump(
+            [saved.Hs, saved.vqe_params0, saved.vqe_e0, saved.true_e0, saved.circuit_fun], f
+        )
+
+    _assert_same(vqe.load_vqe(filename), saved)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        test_load_legacy(pathlib.Path(tmp))
@@ -1,6 +1,13 @@
 """Plotting functions for the classes hamiltonians, vqe, qcnn, encoder.
-This functions are not meant to be used directly, but are called within their respective classes"""
+This functions are not meant to be used directly, but are called within their respective classes
+Text is rendered with matplotlib mathtext, set the environment variable QCTUT_USETEX=1
+before importing the package to render it through LaTeX (slower, needs a LaTeX installation)"""
 
+import os
+import weakref
+from functools import lru_cache
+
+import numpy as onp
 import pennylane as qml
 from pennylane import numpy as np
 import jax
@@ -19,10 +26,261 @@ from typing import List, Callable
 
 from matplotlib import rc
 
+# Numba is optional, it only provides a compiled kernel for small confusion matrices
+try:
+    from numba import njit, prange
+
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
 rc("font", **{"family": "sans-serif", "sans-serif": ["Helvetica"]})
 ## for Palatino and other serif fonts use:
 rc("font", **{"family": "serif", "serif": ["Computer Modern Roman"]})
-rc("text", usetex=True)
+# LaTeX rendering spawns external processes for every figure, only enabled on request
+if os.environ.get("QCTUT_USETEX", "0") == "1":
+    rc("text", usetex=True)
+
+# Slices up to this number of states use the Numba kernel (if available)
+# instead of a BLAS call, whose overhead dominates for small matrices
+_NUMBA_MAX_STATES = 64
+
+if _HAS_NUMBA:
+
+    @njit(parallel=True, fastmath=True)
+    def _fidelity_matrix_numba(V, out):
+        N, D = V.shape
+        for i in prange(N):
+            for j in range(N):
+                acc = 0j
+                for k in range(D):
+                    acc += V[i, k].conjugate() * V[j, k]
+                out[i, j] = acc.real * acc.real + acc.imag * acc.imag
+
+
+def _fidelity_matrix(vectors):
+    """
+    Matrix of the fidelities |<v_i|v_j>|^2 among an array of states
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        Array of states, shape (n_states, 2**N)
+
+    Returns
+    -------
+    np.ndarray
+        Fidelity matrix (float32), shape (n_states, n_states)
+    """
+    # Single precision is enough for the fidelities to be plotted, and the states
+    # from JAX are already complex64: the matmul runs as CGEMM with half the memory traffic
+    # (plain numpy arrays, Numba does not accept pennylane tensors)
+    vectors = onp.ascontiguousarray(qml.math.to_numpy(vectors), dtype=onp.complex64)
+
+    if _HAS_NUMBA and len(vectors) <= _NUMBA_MAX_STATES:
+        c_matrix = onp.zeros((len(vectors), len(vectors)), dtype=onp.float32)
+        _fidelity_matrix_numba(vectors, c_matrix)
+
+        return c_matrix
+
+    # All the overlaps <v_i|v_j> in a single matmul,
+    # |<v_i|v_j>|^2 as re^2 + im^2
+    G = np.dot(np.conj(vectors), vectors.T)
+
+    return G.real * G.real + G.imag * G.imag
+
+
+@lru_cache(maxsize=32)
+def _ticks(n_kappas: int, n_hs: int, kappa_max: float, h_max: float):
+    """
+    Positions and labels of the ticks of the parameter space,
+    computed once for every shape of the Hamiltonian class
+
+    Returns
+    -------
+    tuple
+        ticks_x, ticks_y, labels_x (kappa), labels_y (h, decreasing)
+    """
+    ticks_x = (-.5 , n_kappas/4 - .5, n_kappas/2 - .5 , 3*n_kappas/4 - .5, n_kappas - .5)
+    ticks_y = (-.5 , n_hs/4 - .5, n_hs/2 - .5 , 3*n_hs/4 - .5, n_hs - .5)
+    labels_x = tuple(np.round(k * kappa_max / 4, 2) for k in range(0, 5))
+    labels_y = tuple(np.round(k * h_max / 4, 2) for k in range(4, -1, -1))
+
+    return ticks_x, ticks_y, labels_x, labels_y
+
+
+def _build_accuracy_colors():
+    """
+    Colors of the accuracy colormap: 25 shades of blue-green for the good
+    accuracies followed by 100 shades of red for the bad ones
+    """
+    colors_good = np.squeeze(
+        np.dstack(
+            (
+                np.dstack((np.linspace(0.3, 0, 25), np.linspace(0.8, 1, 25))),
+                np.linspace(1, 0, 25),
+            )
+        )
+    )
+    colors_bad = np.squeeze(
+        np.dstack((np.dstack((np.linspace(1, 0, 100), [0] * 100)), [0] * 100))
+    )
+
+    return np.vstack((colors_good, colors_bad))
+
+
+# Colormap of the VQE accuracies, it does not depend on the data
+_CMAP_ACC = LinearSegmentedColormap.from_list("accuracies", _build_accuracy_colors())
+
+
+def _vqe_state_fns(vqeclass):
+    """
+    Get the jitted functions of the VQE circuit used by the plots,
+    built on the first call and stored on the instance (rebuilt if its circuit
+    or device changed), so replotting does not trace them again
+
+    Parameters
+    ----------
+    vqeclass : vqe.vqe
+        Custom VQE class
+
+    Returns
+    -------
+    fun
+        Jitted fidelity jv_fidelity(true_states, vqe_params)
+    fun
+        Jitted vmapped state circuit jv_state(vqe_params)
+    """
+    key = (vqeclass.circuit, vqeclass.device)
+    cached = vqeclass.__dict__.get("_plot_state_fns")
+    if cached is None or cached[0] != key:
+        # Prepare the quantum circuit to output the state
+        @qml.qnode(vqeclass.device, interface="jax")
+        def q_vqe_state(vqe_params):
+            vqeclass.circuit(vqe_params)
+
+            return qml.state()
+
+        jv_fidelity = jax.jit(lambda true, pars: losses.vqe_fidelities(true, pars, q_vqe_state))
+        jv_state = jax.jit(jax.vmap(q_vqe_state, in_axes=(0)))
+        cached = (key, (jv_fidelity, jv_state))
+        vqeclass.__dict__["_plot_state_fns"] = cached
+
+    return cached[1]
+
+
+# Ahead-of-time compiled executables, one for each (function, shapes and dtypes of the arguments),
+# dropped together with the jitted function
+_EXE = weakref.WeakKeyDictionary()
+
+
+def _aot_call(jit_fn: Callable, *args):
+    """
+    Call a jitted function through its ahead-of-time compiled executable:
+    lowered and compiled on the first call for the given shapes and dtypes,
+    later calls run the executable directly, skipping the tracing and the cache lookup of jit
+
+    Parameters
+    ----------
+    jit_fn : fun
+        Jitted function (jax.jit)
+    *args
+        Arguments of the function (arrays)
+
+    Returns
+    -------
+    Any
+        Output of jit_fn(*args)
+    """
+    args = tuple(jnp.asarray(arg) for arg in args)
+    key = tuple((arg.shape, arg.dtype) for arg in args)
+    executables = _EXE.setdefault(jit_fn, {})
+    if key not in executables:
+        executables[key] = jit_fn.lower(*args).compile()
+
+    return executables[key](*args)
+
+
+def _imshow_grid(values, Hs, **kwargs):
+    """
+    imshow of a quantity defined on the (kappa, h) points of the parameter space,
+    shared by all the plots so they use the same orientation as plot_layout
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values of the points, either flat (n_states[, 3]) or (n_kappas, n_hs[, 3])
+    Hs : hamiltonians.hamiltonian
+        Custom hamiltonian class
+    **kwargs
+        Keyword arguments passed to plt.imshow
+
+    Returns
+    -------
+    matplotlib.image.AxesImage
+        Image of the grid
+    """
+    kwargs.setdefault("aspect", Hs.n_kappas / Hs.n_hs)
+
+    return plt.imshow(_to_grid(values, Hs), **kwargs)
+
+
+def _to_grid(values, Hs):
+    """
+    Arrange the values of the points of the parameter space as displayed:
+    kappa on the horizontal axis, h on the vertical axis going upwards
+    """
+    grid = np.reshape(values, (Hs.n_kappas, Hs.n_hs, -1))
+    if grid.shape[-1] == 1:
+        grid = grid[..., 0]
+
+    # np.rot90 returns a view, the grid is not copied
+    return np.rot90(grid)
+
+
+class PlotContext:
+    """
+    Handles of a heatmap already drawn (figure and image), kept to replot new
+    data on it without building the figure, ticks, lines and legend again
+    """
+
+    def __init__(self, fig, image):
+        self.fig = fig
+        self.image = image
+
+    def alive(self) -> bool:
+        """True if the figure was not closed"""
+        return plt.fignum_exists(self.fig.number)
+
+    def update(self, grid):
+        """Replace the data of the image (the colorbar follows the new limits)"""
+        self.image.set_data(grid)
+        self.image.autoscale()
+        self.fig.canvas.draw_idle()
+        plt.figure(self.fig.number)
+
+
+def _remember_plot(obj, key: str, image):
+    """Store the PlotContext of a heatmap on obj, to be reused by _replot"""
+    obj.__dict__.setdefault("_plot_ctx", {})[key] = PlotContext(image.figure, image)
+
+
+def _replot(obj, key: str, values, Hs) -> bool:
+    """
+    Update the heatmap stored on obj under key with new values
+
+    Returns
+    -------
+    bool
+        False if there is no such heatmap still open, the figure needs to be built
+    """
+    ctx = obj.__dict__.get("_plot_ctx", {}).get(key)
+    if ctx is None or not ctx.alive():
+        return False
+
+    ctx.update(_to_grid(values, Hs))
+
+    return True
 
 #  __           _______  _______ .__   __.  _______ .______          ___       __      
 # /_ |         /  _____||   ____||  \ |  | |   ____||   _  \        /   \     |  |     
@@ -51,22 +309,29 @@ def getlines_from_Hs(
         > general.peshel_emery :Peshel Emery Line.
     """
 
-    # Get information from vqeclass for plotting
-    # (func needs to be resized)
-    side_x = Hs.n_kappas
-    side_y = Hs.n_hs
-    max_x  = Hs.kappa_max
-
-    yrange = [0, Hs.h_max]
-    
-    xs = np.linspace(xrange[0], xrange[1], res)
-    ys = func(xs)
+    # The geometry of Hs does not change, the resized curves are computed
+    # once for each (func, xrange, res) and then only plotted
+    lines_cache = Hs.__dict__.setdefault("_lines_cache", {})
+    key = (func, tuple(xrange), res)
+    if key not in lines_cache:
+        # Get information from vqeclass for plotting
+        # (func needs to be resized)
+        side_x = Hs.n_kappas
+        side_y = Hs.n_hs
+        max_x  = Hs.kappa_max
+
+        yrange = [0, Hs.h_max]
+        
+        xs = np.linspace(xrange[0], xrange[1], res)
+        ys = func(xs)
 
-    ys[ys > yrange[1]] = yrange[1]
-    
-    corrected_xs = (side_x * xs / max_x - 0.5)
+        ys[ys > yrange[1]] = yrange[1]
+        
+        corrected_xs = (side_x * xs / max_x - 0.5)
+        corrected_ys = side_y - ys * side_y / yrange[1] - 0.5
+        lines_cache[key] = (corrected_xs, corrected_ys)
 
-    plt.plot(corrected_xs, side_y - ys * side_y / yrange[1] - 0.5, **kwargs)
+    plt.plot(*lines_cache[key], **kwargs)
 
 def plot_layout(Hs, pe_line, phase_lines, title, figure_already_defined = False):
     """
@@ -95,16 +360,9 @@ def plot_layout(Hs, pe_line, phase_lines, title, figure_already_defined = False)
     plt.xlabel(r"$\kappa$", fontsize=24)
     plt.tick_params(axis="x", labelsize=18)
     plt.tick_params(axis="y", labelsize=18)
-    ticks_x = [-.5 , Hs.n_kappas/4 - .5, Hs.n_kappas/2 - .5 , 3*Hs.n_kappas/4 - .5, Hs.n_kappas - .5]
-    ticks_y = [-.5 , Hs.n_hs/4 - .5, Hs.n_hs/2 - .5 , 3*Hs.n_hs/4 - .5, Hs.n_hs - .5]
-    plt.xticks(
-        ticks= ticks_x,
-        labels=[np.round(k * Hs.kappa_max  / 4, 2) for k in range(0, 5)],
-    )
-    plt.yticks(
-        ticks=ticks_y,
-        labels=[np.round(k * Hs.h_max / 4, 2) for k in range(4, -1, -1)],
-    )
+    ticks_x, ticks_y, labels_x, labels_y = _ticks(Hs.n_kappas, Hs.n_hs, Hs.kappa_max, Hs.h_max)
+    plt.xticks(ticks=ticks_x, labels=labels_x)
+    plt.yticks(ticks=ticks_y, labels=labels_y)
 
     if pe_line:
         getlines_from_Hs(Hs, qmlgen.peshel_emery, [0, 0.5], res=100, color = "blue", alpha=1, ls = '--', dashes=(4,5), label = 'Peshel-Emery line')
@@ -134,7 +392,7 @@ def plot_layout(Hs, pe_line, phase_lines, title, figure_already_defined = False)
 #  / /_   __    |  |  |  |  /  _____  \  |  |  |  | |  | |  `----.    |  |     |  `--'  | |  |\   | |  |  /  _____  \  |  |\   | .----)   |   
 # |____| (__)   |__|  |__| /__/     \__\ |__|  |__| |__| |_______|    |__|      \______/  |__| \__| |__| /__/     \__\ |__| \__| |_______/    
                                                                                                                                             
-def HAM_mass_gap(Hs, phase_lines = False, pe_line = False):
+def HAM_mass_gap(Hs, phase_lines = False, pe_line = False, reuse_figure = False):
     """
     Shows the mass gap which is defined as the difference between the first excited leven and the ground energy level
     for each point in the parameter space.
@@ -147,17 +405,22 @@ def HAM_mass_gap(Hs, phase_lines = False, pe_line = False):
         if True plots the phase transition lines
     pe_line : bool
         if True plots Peshel Emery line
+    reuse_figure : bool
+        if True and the mass gap figure is still open, only its data is updated
     """
     
     sidex = Hs.n_kappas
     sidey = Hs.n_hs
 
     # Compute the massgap
-    mass_gap = np.reshape(Hs.true_e1 - Hs.true_e0, (sidex, sidey) )
+    mass_gap = np.reshape(Hs.true_e1 - Hs.true_e0, (sidex, sidey))
     
+    if reuse_figure and _replot(Hs, "mass_gap", mass_gap, Hs):
+        return
+
     plot_layout(Hs, phase_lines=phase_lines, pe_line=pe_line, title=r"Mass Gap,     $N = {0}$".format(str(Hs.N)))
 
-    plt.imshow(np.rot90(mass_gap), aspect = Hs.n_kappas / Hs.n_hs)
+    _remember_plot(Hs, "mass_gap", _imshow_grid(mass_gap, Hs))
 
     cbar = plt.colorbar(fraction=0.04)
     cbar.ax.tick_params(labelsize=16)
@@ -174,36 +437,27 @@ def HAM_phases_plot(Hs):
 
     sidex = Hs.n_kappas
     sidey = Hs.n_hs
-    xs = np.linspace(0,Hs.kappa_max,sidex)
-    ys = np.linspace(0,Hs.h_max,sidey)
+    # ogrid-like column (kappa) and row (h) vectors, no full 2D grid of coordinates
+    # (pennylane.numpy has no ogrid)
+    xs = np.linspace(0,Hs.kappa_max,sidex).reshape(sidex, 1)
+    ys = np.linspace(0,Hs.h_max,sidey).reshape(1, sidey)
 
     # Mark every point of the parameter space to its corresponding phase according to the
     # state-of-the-art transition lines
-    phases = []
-    for x in xs:
-        for y in ys:
-            if x == 0:
-                if y <= 1:
-                    phases.append(0)
-                else:
-                    phases.append(1)
-            elif x <= .5:
-                if y <= qmlgen.paraferro(x):
-                    phases.append(0)
-                else:
-                    phases.append(1)
-            else:
-                if y <= qmlgen.paraanti(x):
-                    phases.append(2)
-                else:
-                    phases.append(1)
-                    
+    # The lines depend only on x: evaluate them once on the column and broadcast over y
+    # (paraferro(0) and paraanti(x < .5) are invalid and not used, hence errstate)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        border = np.where(
+            xs == 0, 1, np.where(xs <= .5, qmlgen.paraferro(xs), qmlgen.paraanti(xs))
+        )
+    phases = np.where(ys <= border, np.where(xs <= .5, 0, 2), 1)
+
     cmap = colors.ListedColormap(['palegreen', 'moccasin', 'lightblue'])
     bounds=[0,1,2,3]
     norm = colors.BoundaryNorm(bounds, cmap.N)
 
     plot_layout(Hs, pe_line=False, phase_lines=True, title = r"State of the art phases plot")
-    plt.imshow(np.rot90(np.reshape(phases, (sidex,sidey))), cmap=cmap, norm = norm, aspect = Hs.n_kappas / Hs.n_hs)
+    _imshow_grid(phases, Hs, cmap=cmap, norm = norm)
 
 #  ____          ____    ____  ______      _______ 
 # |___ \         \   \  /   / /  __  \    |   ____|
@@ -238,9 +492,12 @@ def VQE_show_isingchain(vqeclass):
     ax[0].set_ylabel(r"$E(\lambda)$")
     ax[0].legend()
 
-    accuracy = np.abs((true_e - vqe_e) / true_e)
-    ax[1].fill_between(lams, 0.01, max(np.max(accuracy), 0.01), color="r", alpha=0.3)
-    ax[1].fill_between(lams, 0.01, min(np.min(accuracy), 0), color="green", alpha=0.3)
+    accuracy = np.asarray(np.abs((true_e - vqe_e) / true_e))
+    # Limits of the bands as plain floats, computed once
+    band_top = max(float(accuracy.max()), 0.01)
+    band_bottom = min(float(accuracy.min()), 0.0)
+    ax[1].fill_between(lams, 0.01, band_top, color="r", alpha=0.3)
+    ax[1].fill_between(lams, 0.01, band_bottom, color="green", alpha=0.3)
     ax[1].axhline(y=0.01, color="r", linestyle="--")
     ax[1].scatter(lams, accuracy)
     ax[1].grid(True)
@@ -276,14 +533,13 @@ def VQE_show_annni(vqeclass, log_heatmap = False, plot3d=True, phase_lines = Fal
     # Matrix of the true energies E_true
     trues = np.reshape(vqeclass.Hs.true_e0, (sidex, sidey))
     # Matrix of the VQE energies E_pred
-    preds = np.reshape(vqeclass.vqe_e0,  (sidex, sidey))
-
-    # Accuracy := |E_true - E_pred|/|E_true|
-
-    x = np.linspace(-max_x, 0, sidex)
-    y = np.linspace(0, max_y, sidey)
+    preds = np.reshape(vqeclass.vqe_e0, (sidex, sidey))
 
     if plot3d:
+        # Axes of the surfaces, only needed here
+        x = np.linspace(-max_x, 0, sidex)
+        y = np.linspace(0, max_y, sidey)
+
         fig = go.Figure(
             data=[
                 # x and y needed to be swapped for it to properly show the graph
@@ -299,33 +555,19 @@ def VQE_show_annni(vqeclass, log_heatmap = False, plot3d=True, phase_lines = Fal
     plot_layout(vqeclass.Hs, pe_line=pe_line, phase_lines=phase_lines, title = r"VQE,     $N = {0}$".format(str(vqeclass.Hs.N)))
 
     # Accuracy := |E_true - E_pred|/|E_true|
-    accuracy = np.rot90(np.abs(preds - trues) / np.abs(trues))
+    accuracy = np.abs(preds - trues) / np.abs(trues)
     
     if not log_heatmap:
-        colors_good = np.squeeze(
-            np.dstack(
-                (
-                    np.dstack((np.linspace(0.3, 0, 25), np.linspace(0.8, 1, 25))),
-                    np.linspace(1, 0, 25),
-                )
-            )
-        )
-        colors_bad = np.squeeze(
-            np.dstack((np.dstack((np.linspace(1, 0, 100), [0] * 100)), [0] * 100))
-        )
-        colors = np.vstack((colors_good, colors_bad))
-        cmap_acc = LinearSegmentedColormap.from_list("accuracies", colors)
-
-        plt.imshow(accuracy, cmap=cmap_acc, aspect = vqeclass.Hs.n_kappas / vqeclass.Hs.n_hs)
+        _imshow_grid(accuracy, vqeclass.Hs, cmap=_CMAP_ACC)
         plt.clim(0, 0.05)
         cbar = plt.colorbar(fraction=0.04)
         cbar.ax.tick_params(labelsize=16) 
     else:
-        plt.imshow(accuracy, norm=LogNorm(), aspect = vqeclass.Hs.n_kappas / vqeclass.Hs.n_hs)
+        _imshow_grid(accuracy, vqeclass.Hs, norm=LogNorm())
         cbar = plt.colorbar(fraction=0.04)
         cbar.ax.tick_params(labelsize=16)
 
-def VQE_psi_truepsi_fidelity(vqeclass, phase_lines = False, pe_line = False):
+def VQE_psi_truepsi_fidelity(vqeclass, phase_lines = False, pe_line = False, reuse_figure = False):
     """
     For each VQE resulting state, show its fidelity compared to its true state obtained through diagonalization of the Hamiltonian:
 
@@ -337,26 +579,32 @@ def VQE_psi_truepsi_fidelity(vqeclass, phase_lines = False, pe_line = False):
         if True plots the phase transition lines
     pe_line : bool
         if True plots Peshel Emery line
+    reuse_figure : bool
+        if True and the fidelity figure is still open, only its data is updated
+        (e.g. when replotting during training)
     """
 
     sidex = vqeclass.Hs.n_kappas
     sidey = vqeclass.Hs.n_hs
 
-    # Prepare the quantum circuit to output the state
-    @qml.qnode(vqeclass.device, interface="jax")
-    def q_vqe_state(vqe_params):
-        vqeclass.circuit(vqe_params)
-
-        return qml.state()
-
     # Jit and vmapped function to compute the fidelity
-    jv_fidelity = jax.jit(lambda true, pars: losses.vqe_fidelities(true, pars, q_vqe_state))
+    jv_fidelity, _ = _vqe_state_fns(vqeclass)
     
-    fidelity_map = jv_fidelity(vqeclass.Hs.true_psi0, vqeclass.vqe_params0) 
-    fidelity_map = np.reshape(fidelity_map, (sidex, sidey))
+    # Recomputed only if the parameters were trained since the last plot
+    cached = vqeclass.__dict__.get("_fidelity_map_2d")
+    if cached is not None and cached[0] == vqeclass._params_version:
+        fidelity_map = cached[1]
+    else:
+        fidelity_map = np.reshape(
+            _aot_call(jv_fidelity, vqeclass.Hs.true_psi0, vqeclass.vqe_params0), (sidex, sidey)
+        )
+        vqeclass.__dict__["_fidelity_map_2d"] = (vqeclass._params_version, fidelity_map)
+
+    if reuse_figure and _replot(vqeclass, "fidelity", fidelity_map, vqeclass.Hs):
+        return
 
     plot_layout(vqeclass.Hs, phase_lines=phase_lines, pe_line=pe_line, title=r"Fidelities,     $N = {0}$".format(str(vqeclass.Hs.N)))
-    plt.imshow(np.rot90(fidelity_map), aspect = vqeclass.Hs.n_kappas / vqeclass.Hs.n_hs)
+    _remember_plot(vqeclass, "fidelity", _imshow_grid(fidelity_map, vqeclass.Hs))
     cbar = plt.colorbar(fraction=0.04)
     cbar.ax.tick_params(labelsize=16) 
 
@@ -382,6 +630,9 @@ def VQE_fidelity_slice(vqeclass, slice_value, axis = 0, truestates = False):
     #########################################################
     # 1. Show the parameter space and the line of the slice #
     #########################################################
+    sidey, ymax = vqeclass.Hs.n_hs, vqeclass.Hs.h_max
+    sidex, xmax = vqeclass.Hs.n_kappas, vqeclass.Hs.kappa_max
+
     if axis == 0:
         plt.axhline(y = sidey - slice_value*sidey/ymax - .5, color='blue', lw=2)
     elif axis == 1:
@@ -390,12 +641,8 @@ def VQE_fidelity_slice(vqeclass, slice_value, axis = 0, truestates = False):
         raise ValueError('Invalid axis, it can only be either 0 or 1')
 
     vqeclass.Hs.show_phasesplot()
-    
-    sidey, ymax = vqeclass.Hs.n_hs, vqeclass.Hs.h_max
-    sidex, xmax = vqeclass.Hs.n_kappas, vqeclass.Hs.kappa_max
 
-    ticks_x = [-.5 , vqeclass.Hs.n_kappas/4 - .5, vqeclass.Hs.n_kappas/2 - .5 , 3*vqeclass.Hs.n_kappas/4 - .5, vqeclass.Hs.n_kappas - .5]
-    ticks_y = [-.5 , vqeclass.Hs.n_hs/4 - .5, vqeclass.Hs.n_hs/2 - .5 , 3*vqeclass.Hs.n_hs/4 - .5, vqeclass.Hs.n_hs - .5]
+    ticks_x, ticks_y, labels_x, labels_y = _ticks(sidex, sidey, xmax, ymax)
 
     plt.show()
 
@@ -403,12 +650,7 @@ def VQE_fidelity_slice(vqeclass, slice_value, axis = 0, truestates = False):
     # 2. Show the confusion matrix of fidelities of the states #
     ############################################################
     def create_confusion_matrix(vectors):
-        dimvec = len(vectors)
-        c_matrix = np.zeros((dimvec, dimvec))
-
-        for i in range(dimvec):
-            for j in range(dimvec):
-                c_matrix[i,j] = np.square( np.real(vectors[i] @ np.conj(vectors[j]) ) )
+        c_matrix = _fidelity_matrix(vectors)
 
         plt.imshow(c_matrix, origin = 'lower')
         
@@ -423,14 +665,8 @@ def VQE_fidelity_slice(vqeclass, slice_value, axis = 0, truestates = False):
         indexes = np.arange(starting_index,sidex*sidey,sidey).astype(int)
         print(indexes)
         print(len(indexes))
-        plt.xticks(
-        ticks= ticks_x,
-        labels=[np.round(k * vqeclass.Hs.kappa_max  / 4, 2) for k in range(0, 5)],
-        )
-        plt.yticks(
-            ticks=ticks_x,
-            labels=[np.round(k * vqeclass.Hs.kappa_max  / 4, 2) for k in range(0, 5)],
-        )
+        plt.xticks(ticks=ticks_x, labels=labels_x)
+        plt.yticks(ticks=ticks_x, labels=labels_x)
         plt.ylabel(r"$\kappa$", fontsize=24)
         plt.xlabel(r"$\kappa$", fontsize=24)
         title = f'h = {slice_value}'
@@ -438,14 +674,8 @@ def VQE_fidelity_slice(vqeclass, slice_value, axis = 0, truestates = False):
         indexes = np.arange(int(sidex*slice_value)*sidey,sidex*(int(sidey*slice_value))+sidex,1).astype(int)
         print(indexes)
         print(len(indexes))
-        plt.xticks(
-        ticks= ticks_y,
-        labels=[np.round(k * vqeclass.Hs.h_max / 4, 2) for k in range(4, -1, -1)],
-        )
-        plt.yticks(
-            ticks=ticks_y,
-            labels=[np.round(k * vqeclass.Hs.h_max / 4, 2) for k in range(4, -1, -1)],
-        )
+        plt.xticks(ticks=ticks_y, labels=labels_y)
+        plt.yticks(ticks=ticks_y, labels=labels_y)
         plt.ylabel(r"$h$", fontsize=24)
         plt.xlabel(r"$h$", fontsize=24)
         title = f'k = {slice_value}'
@@ -459,14 +689,9 @@ def VQE_fidelity_slice(vqeclass, slice_value, axis = 0, truestates = False):
             vqeclass.Hs.add_true()
         confusion = create_confusion_matrix(np.array(vqeclass.Hs.true_psi0)[indexes])
     else:
-        # Quantum circuit for computing the states from the parameters
-        @qml.qnode(vqeclass.device, interface="jax")
-        def q_vqe_state(vqe_params):
-            vqeclass.circuit(vqe_params)
-
-            return qml.state()
-
-        vqe_psi0 = jax.jit(jax.vmap(q_vqe_state, in_axes=(0)))(vqeclass.vqe_params0[indexes])
+        # Jitted circuit for computing the states from the parameters
+        _, jv_state = _vqe_state_fns(vqeclass)
+        vqe_psi0 = _aot_call(jv_state, vqeclass.vqe_params0[indexes])
         confusion = create_confusion_matrix(vqe_psi0)
 
     leg = plt.legend(
@@ -504,44 +729,24 @@ def QCNN_classification_ising(qcnnclass, train_index):
         List of the indexes of the training set. On displaying they will be marked with a different colour
     """
 
-    # Quantum Circuit to output the probabilities
-    @qml.qnode(qcnnclass.device, interface="jax")
-    def qcnn_circuit_prob(params_vqe, params):
-        qcnnclass._vqe_qcnn_circuit(params_vqe, params)
+    # Compiled circuit outputting the probabilities, shared with qcnn.predict
+    vcircuit = qcnnclass.jv_qcnn_circuit_prob
+    predictions = qmlgen.chunked_map(
+        lambda X: _aot_call(vcircuit, X, qcnnclass.params)[:, 1], qcnnclass.vqe_params
+    )
 
-        return qml.probs(wires=qcnnclass.N - 1)
+    # Mask of the training set, the test set is its complement
+    train_mask = np.zeros(len(predictions), dtype=bool)
+    train_mask[train_index] = True
+    test_index = np.flatnonzero(~train_mask)
 
-    vcircuit = jax.vmap(lambda v: qcnn_circuit_prob(v, qcnnclass.params), in_axes=(0))
-    predictions = vcircuit(qcnnclass.vqe_params)[:, 1]
-    
-    # The test index is the set difference of the whole dataset and the training set
-    test_index = np.setdiff1d(np.arange(len(qcnnclass.vqe_params)), train_index)
-
-    predictions_train, colors_train = [], []
-    predictions_test,  colors_test  = [], []
-
-    for i, prediction in enumerate(predictions):
-        # if data in training set
-        if i in train_index:
-            predictions_train.append(prediction)
-            if np.round(prediction) == 0:
-                colors_train.append("green") if qcnnclass.labels[
-                    i
-                ] == 0 else colors_train.append("red")
-            else:
-                colors_train.append("red") if qcnnclass.labels[
-                    i
-                ] == 0 else colors_train.append("green")
-        else:
-            predictions_test.append(prediction)
-            if np.round(prediction) == 0:
-                colors_test.append("green") if qcnnclass.labels[
-                    i
-                ] == 0 else colors_test.append("red")
-            else:
-                colors_test.append("red") if qcnnclass.labels[
-                    i
-                ] == 0 else colors_test.append("green")
+    # Green if the rounded prediction agrees with the label, red otherwise
+    correct = (np.round(predictions) == 0) == (np.asarray(qcnnclass.labels) == 0)
+    colors_all = np.where(correct, "green", "red")
+
+    # (colors as lists of str, matplotlib does not accept pennylane tensors of str)
+    predictions_train, colors_train = predictions[train_mask], colors_all[train_mask].tolist()
+    predictions_test,  colors_test  = predictions[~train_mask], colors_all[~train_mask].tolist()
 
     fig, ax = plt.subplots(2, 1, figsize=(16, 10))
 
@@ -621,55 +826,28 @@ def QCNN_classification_ANNNI_marginal(qcnnclass):
         np.arange( len(mask2[mask2 == True]) )
     )
 
-    vcircuit = jax.vmap(lambda v: qcnn_circuit_prob(v, qcnnclass.params), in_axes=(0))
-    predictions1 = vcircuit(ising_1)
-    predictions2 = vcircuit(ising_2)
-
-    out1_p1, out2_p1, c1 = [], [], []
-    for idx, pred in enumerate(predictions1):
-        out1_p1.append(pred[0][1])
-        out2_p1.append(pred[1][1])
-
-        if (np.argmax(pred[0]) == label_1[idx][0]) and (
-            np.argmax(pred[1]) == label_1[idx][1]
-        ):
-            c1.append("green")
-        else:
-            c1.append("red")
-
-    fig, ax = plt.subplots(1, 2, figsize=(20, 6))
-
-    ax[0].grid(True)
-    ax[0].scatter(x1, out1_p1, c=c1)
-    ax[0].set_ylim(-0.1, 1.1)
-    ax[1].grid(True)
-    ax[1].scatter(x1, out2_p1, c=c1)
-    ax[1].set_ylim(-0.1, 1.1)
+    # Both subsets in a single compiled call, split back afterwards
+    vcircuit = jax.jit(jax.vmap(lambda v: qcnn_circuit_prob(v, qcnnclass.params), in_axes=(0)))
+    predictions = np.asarray(vcircuit(jnp.concatenate([ising_1, ising_2])))
+    predictions1, predictions2 = predictions[:len(x1)], predictions[len(x1):]
 
-    plt.show()
+    for x, pred, label in [(x1, predictions1, label_1), (x2, predictions2, label_2)]:
+        # Probability of 1 on each output wire
+        out1_p, out2_p = pred[:, 0, 1], pred[:, 1, 1]
+        # Green if both outputs match the labels, red otherwise
+        correct = np.all(np.argmax(pred, axis=-1) == label, axis=1)
+        c = np.where(correct, "green", "red").tolist()
 
-    out1_p2, out2_p2, c2 = [], [], []
-    for idx, pred in enumerate(predictions2):
-        out1_p2.append(pred[0][1])
-        out2_p2.append(pred[1][1])
+        fig, ax = plt.subplots(1, 2, figsize=(20, 6))
 
-        if (np.argmax(pred[0]) == label_2[idx][0]) and (
-            np.argmax(pred[1]) == label_2[idx][1]
-        ):
-            c2.append("green")
-        else:
-            c2.append("red")
+        ax[0].grid(True)
+        ax[0].scatter(x, out1_p, c=c)
+        ax[0].set_ylim(-0.1, 1.1)
+        ax[1].grid(True)
+        ax[1].scatter(x, out2_p, c=c)
+        ax[1].set_ylim(-0.1, 1.1)
 
-    fig, ax = plt.subplots(1, 2, figsize=(20, 6))
-
-    ax[0].grid(True)
-    ax[0].scatter(x2, out1_p2, c=c2)
-    ax[0].set_ylim(-0.1, 1.1)
-    ax[1].grid(True)
-    ax[1].scatter(x2, out2_p2, c=c2)
-    ax[1].set_ylim(-0.1, 1.1)
-
-    plt.show()
+        plt.show()
 
 def QCNN_classification_ANNNI(
     qcnnclass,
@@ -710,21 +888,19 @@ def QCNN_classification_ANNNI(
         )
         norm = mpl.colors.BoundaryNorm(np.arange(0, 5), phases.N)
 
-        plt.imshow(np.rot90(np.reshape(predictions, (sidex, sidey))), cmap=phases, norm=norm, aspect = qcnnclass.vqe.Hs.n_kappas / qcnnclass.vqe.Hs.n_hs)
+        _imshow_grid(predictions, qcnnclass.vqe.Hs, cmap=phases, norm=norm)
 
     else:
         mygreen = np.array([90, 255, 100]) / 255
         myblue = np.array([50, 50, 200]) / 255
         myyellow = np.array([300, 270, 0]) / 255
 
-        rgb_probs = np.ndarray(shape=(sidex * sidey, 3), dtype=float)
-
-        for i, pred in enumerate(predictions):
-            rgb_probs[i] = pred[3] * mygreen + pred[1] * myblue + pred[2] * myyellow
-
-        rgb_probs = np.rot90(np.reshape(rgb_probs, (sidex, sidey, 3)))
+        # Color of each point: P(3) * green + P(1) * blue + P(2) * yellow,
+        # as a single (n_states, 3) @ (3, 3) matmul
+        basis = np.stack([mygreen, myblue, myyellow])
+        rgb_probs = np.asarray(predictions)[:, [3, 1, 2]] @ basis
 
-        plt.imshow(rgb_probs, alpha=1, aspect = qcnnclass.vqe.Hs.n_kappas / qcnnclass.vqe.Hs.n_hs)
+        _imshow_grid(rgb_probs, qcnnclass.vqe.Hs, alpha=1)
 
         if predicted_line:
             plt.plot(qcnnclass.predict_lines(predictions=predictions), color='magenta', label='Predicted Transition Lines')
@@ -792,9 +968,6 @@ def ENC_show_compression_ANNNI(encclass, trainingpoint=False, label=False, plot3
     sidey = encclass.vqe.Hs.n_hs
     max_x = encclass.vqe.Hs.kappa_max
     max_y = encclass.vqe.Hs.h_max
-    x = np.linspace(-max_x, 0, sidex)
-    y = np.linspace(0, max_y, sidey)
-
     X = jnp.array(encclass.vqe_params0)
 
     @qml.qnode(encclass.device, interface="jax")
@@ -803,20 +976,26 @@ def ENC_show_compression_ANNNI(encclass, trainingpoint=False, label=False, plot3
 
         return [qml.expval(qml.PauliZ(int(k))) for k in encclass.wires_trash]
 
-    v_encoder_circuit = jax.vmap(lambda p: encoder_circuit(p, encclass.params))
-
-    exps = (1 - np.sum(v_encoder_circuit(X), axis=1) / 4) / 2
+    # vmap, sum over the trash wires and rescaling fused in a single jitted function,
+    # only the (n_states,) compression scores are transferred back
+    j_scores = jax.jit(
+        jax.vmap(lambda p: (1 - jnp.sum(jnp.asarray(encoder_circuit(p, encclass.params))) / 4) / 2)
+    )
 
-    exps = np.rot90(np.reshape(exps, (sidex, sidey)))
+    exps = qmlgen.chunked_map(j_scores, X)
 
     if plot3d:
-        fig = go.Figure(data=[go.Surface(z=exps, x=x, y=y)])
+        # Axes of the surface, only needed here
+        x = np.linspace(-max_x, 0, sidex)
+        y = np.linspace(0, max_y, sidey)
+
+        fig = go.Figure(data=[go.Surface(z=np.rot90(np.reshape(exps, (sidex, sidey))), x=x, y=y)])
         fig.update_layout(height=500)
         fig.show()
 
     plt.figure(figsize=(8, 6), dpi=80)
     plot_layout(encclass.vqe.Hs, pe_line=True, phase_lines=True, title='')
-    plt.imshow(exps, aspect = encclass.vqe.Hs.n_kappas / encclass.vqe.Hs.n_hs)
+    _imshow_grid(exps, encclass.vqe.Hs)
     if type(trainingpoint) == int:
         train_x = trainingpoint // sidey
         train_y = sidey - trainingpoint % sidey
@@ -5,9 +5,10 @@ import jax
 import jax.numpy as jnp
 from jax.example_libraries import optimizers
 
-import copy
 from tqdm.auto import tqdm
 import pickle  # Writing and loading
+import zipfile
+import json
 
 import warnings
 
@@ -16,12 +17,12 @@ warnings.filterwarnings(
     message="For Hamiltonians, the eigenvalues will be computed numerically. This may be computationally intensive for a large number of wires.Consider using a sparse representation of the Hamiltonian with qml.SparseHamiltonian.",
 )
 
-from PhaseEstimation import circuits, losses, hamiltonians
+from PhaseEstimation import circuits, hamiltonians
 from PhaseEstimation import general as qmlgen
 from PhaseEstimation import annni_model as annni, ising_chain as ising
 from PhaseEstimation import visualization as qplt
 
-from typing import List, Callable
+from typing import List, Tuple, Callable, Optional
 from numbers import Number
 
 ##############
@@ -94,6 +95,7 @@ def circuit_ising2(N: int, params: List[Number]) -> int:
 def circuit_ising3(N: int, params: List[Number]) -> int:
     """
     Shorter and more real circuit
+    Number of parameters (gates): 7*N
 
     Parameters
     ----------
@@ -124,8 +126,32 @@ def circuit_ising3(N: int, params: List[Number]) -> int:
     return index
 
 
+# Closed-form number of parameters of the VQE circuits as a function of N,
+# circuits not listed here are counted by building them once
+_N_PARAMS = {
+    circuit_ising: lambda N: 7 * N,
+    circuit_ising2: lambda N: 11 * N,
+    circuit_ising3: lambda N: 7 * N,
+}
+
+
+# Circuits that can be saved and loaded by name
+_CIRCUITS = {circuit.__name__: circuit for circuit in _N_PARAMS}
+
+# Building functions of the Hamiltonians that can be saved by name
+_HS_FUNCS = {f"{func.__module__}.{func.__name__}": func for func in (ising.build_Hs, annni.build_Hs)}
+# Arrays of the Hamiltonian class saved along with its building function
+_HS_ARRAYS = ("true_e0", "true_psi0", "true_e1", "true_psi1")
+
+
 class vqe:
-    def __init__(self, Hs: hamiltonians.hamiltonian, circuit: Callable):
+    def __init__(
+        self,
+        Hs: hamiltonians.hamiltonian,
+        circuit: Callable,
+        seed: Optional[int] = None,
+        checkpoint: bool = False,
+    ):
         """
         Class for the VQE algorithm
 
@@ -135,18 +161,38 @@ class vqe:
             Custom Hamiltonian class
         circuit : function
             Function of the VQE circuit
+        seed : int
+            (Optional) Seed of the random initialization of the parameters,
+            if None it is drawn from np.random (so np.random.seed still applies)
+        checkpoint : bool
+            if True -> The layers of the circuit are recomputed in the backward pass
+            instead of stored (lower memory for many qubits, slower compilation).
+            Circuits with gates the batched simulation does not support are
+            recomputed as a whole
         """
         self.Hs = Hs
         self.circuit = lambda p: circuit(self.Hs.N, p)
         self.circuit_fun = circuit
-        # Pass the parameter array [0]*10000 (intentionally large) to the circuit
-        # which it will output `index`, namely the number of parameters
-        self.n_params = self.circuit([0] * 10000)
-        # Initialize randomly all the parameter-arrays for each state
-        self.vqe_params0 = jnp.array(
-            np.random.uniform(-np.pi, np.pi, size=(self.Hs.n_states, self.n_params))
+        if circuit in _N_PARAMS:
+            self.n_params = _N_PARAMS[circuit](self.Hs.N)
+        else:
+            # Pass the parameter array [0]*10000 (intentionally large) to the circuit
+            # which it will output `index`, namely the number of parameters
+            self.n_params = self.circuit([0] * 10000)
+        # Initialize randomly all the parameter-arrays for each state,
+        # directly on device with the JAX PRNG
+        if seed is None:
+            seed = int(np.random.randint(2**31 - 1))
+        self.key, subkey = jax.random.split(jax.random.PRNGKey(seed))
+        self.vqe_params0 = jax.random.uniform(
+            subkey, (self.Hs.n_states, self.n_params), minval=-jnp.pi, maxval=jnp.pi
         )
+        # Incremented whenever the training writes vqe_params0,
+        # the plots derived from the parameters are recomputed only when it changes
+        self._params_version = 0
         self.device = qml.device("default.qubit.jax", wires=self.Hs.N, shots=None)
+        # Drawing of the circuit, built on the first print
+        self._drawer = None
 
         ### STATES FUNCTIONS ###
         # QCircuit: CIRCUIT(params) -> PSI
@@ -156,55 +202,77 @@ class vqe:
 
             return qml.state()
 
-        self.v_q_vqe_state = jax.vmap(
-            lambda v: q_vqe_state(v), in_axes=(0)
-        )  # vmap of the state circuit
-        self.jv_q_vqe_state = jax.jit(
-            self.v_q_vqe_state
-        )  # jitted vmap of the state circuit
+        try:
+            # Explicitly batched simulation of the circuit: each gate is a
+            # single einsum on the whole batch of states
+            self.v_q_vqe_state = circuits.batched_state_circuit(
+                self.circuit, self.Hs.N, self.n_params, checkpoint=checkpoint
+            )
+        except NotImplementedError:
+            # Whole circuit recomputed in the backward pass, the qnode is not split in layers
+            state_fn = jax.checkpoint(q_vqe_state) if checkpoint else q_vqe_state
+            self.v_q_vqe_state = jax.vmap(
+                lambda v: state_fn(v), in_axes=(0)
+            )  # vmap of the state circuit
         self.j_q_vqe_state = jax.jit(lambda p: q_vqe_state(p))  # jitted state circuit
 
-        # For updating progress bar on fidelity between true states and vqe states
-        self.jv_fidelties = jax.jit(
-            lambda true, pars: losses.vqe_fidelities(true, pars, q_vqe_state)
-        )
-
         ### ENERGY FUNCTIONS ###
-        # Computes <psi|H|psi>
-        def compute_vqe_E(state, Hmat):
-            return jnp.real(jnp.conj(state) @ Hmat @ state)
+        # Computes <psi|H|psi> from the Pauli terms (structures, weights) of H,
+        # without the dense (2**N, 2**N) matrix
+        def compute_vqe_E(state, terms):
+            return qmlgen.pauli_expval(state, *terms)
+
+        # Batch of states of the same Hamiltonian
+        v_compute_vqe_E = jax.vmap(compute_vqe_E, in_axes=(0, None))
 
-        self.j_compute_vqe_E = jax.jit(compute_vqe_E)
-        self.v_compute_vqe_E = jax.vmap(compute_vqe_E, in_axes=(0, 0))
-        self.jv_compute_vqe_E = jax.jit(self.v_compute_vqe_E)
+        # Fused CIRCUIT(params) -> <psi|H|psi>: the states are produced and
+        # contracted within the same traced function, they never leave the device
+        def v_vqe_E(params, terms):
+            return v_compute_vqe_E(self.v_q_vqe_state(params), terms)
 
         # Loss function: LOSS = 1/n_states SUM_i ( ENERGY(psi_i) )
-        def loss(params, Hs):
-            pred_states = self.v_q_vqe_state(params)
-            vqe_e = self.v_compute_vqe_E(pred_states, Hs)
+        def loss(params, terms):
+            vqe_e = v_vqe_E(params, terms)
 
             # Cast as real because energies are supposed to be it
             return jnp.mean(jnp.real(vqe_e))
 
-        # Grad function, used in updating the parameters
-        self.jd_loss = jax.jit(jax.grad(loss))
+        # Whole optimization of a site as a single compiled loop: no Python dispatch
+        # for each epoch, lr and n_epochs are traced so it is compiled only once.
+        # The energies of the final parameters are computed in the same call
+        def fit(params, terms, lr, n_epochs):
+            # Built at trace time: the optimizer closures are created once per
+            # compilation, each site only gets a fresh optimizer state
+            opt_init, opt_update, get_params = optimizers.adam(lr)
 
-    def __repr__(self):
-        # QCircuit just for printing it
-        @qml.qnode(self.device, interface="jax")
-        def vqe_state(self):
-            # Passing np.arange array for enumerating the parameters
-            self.circuit(np.arange(self.n_params))
+            def epoch(_, opt_state):
+                grads = jax.grad(loss)(get_params(opt_state), terms)
 
-            return qml.state()
+                return opt_update(0, grads, opt_state)
 
-        return qml.draw(vqe_state)(self)
+            opt_state = jax.lax.fori_loop(0, n_epochs, epoch, opt_init(params))
+            params = get_params(opt_state)
 
-    def _update(self, params, Hs_batch, opt_state, opt_update, get_params):
-        grads = self.jd_loss(params, Hs_batch)
-        opt_state = opt_update(0, grads, opt_state)
+            return params, v_vqe_E(params, terms)
 
-        return get_params(opt_state), opt_state
+        self.j_fit = jax.jit(fit)
+        # Independent sites optimized at once
+        self.jv_fit = jax.jit(jax.vmap(fit, in_axes=(0, 0, None, None)))
+
+    def __repr__(self):
+        # The circuit does not change: it is traced and drawn only once
+        if self._drawer is None:
+            # QCircuit just for printing it
+            @qml.qnode(self.device, interface="jax")
+            def vqe_state(self):
+                # Passing np.arange array for enumerating the parameters
+                self.circuit(np.arange(self.n_params))
+
+                return qml.state()
+
+            self._drawer = qml.draw(vqe_state)(self)
+
+        return self._drawer
 
     def _get_neighbours(self, idx: int) -> List[Number]:
         """
@@ -257,28 +325,78 @@ class vqe:
 
         return neighbours
 
+    def _get_terms(self, sites: List[int]) -> Tuple[List[List[List[int]]], List[List[Number]]]:
+        """
+        Stacked Pauli terms (structures, weights) of the Hamiltonians of the sites.
+        Hamiltonians with fewer terms are padded with identities of zero weight
+
+        Parameters
+        ----------
+        sites : List[int]
+            Indexes of the sites
+
+        Returns
+        -------
+        jnp.ndarray
+            Pauli structures, shape (len(sites), n_terms, N)
+        jnp.ndarray
+            Weights, shape (len(sites), n_terms)
+        """
+        terms = [qmlgen.get_pauli_terms(self.Hs.qml_Hs[site], self.Hs.N) for site in sites]
+        n_terms = max(len(weights) for _, weights in terms)
+
+        structures = np.zeros((len(terms), n_terms, self.Hs.N), dtype=int)
+        weights = np.zeros((len(terms), n_terms), dtype=np.single)
+        for k, (structure, weight) in enumerate(terms):
+            structures[k, : len(weight)] = structure
+            weights[k, : len(weight)] = weight
+
+        return jnp.array(structures), jnp.array(weights)
+
     def train_site(self, lr: Number, n_epochs: int, site: int):
         """
         Minimize <psi|H|psi> for a single site
         
         """
-        # Get all the necessary training parameters for the VQD algorithm
-        # > H: Hamiltonian of the model
-        # > H_eff: Effective Hamiltonian for the model (H +|psi><psi|)
-        # > site: index for (L,K) combination
-        H, self.Hs.true_e0[site] = qmlgen.get_VQE_params(self.Hs.qml_Hs[site])
+        # Pauli terms of the Hamiltonian of the site (index for (L,K) combination)
+        structures, weights = self._get_terms([site])
+        terms = (structures[0], weights[0])
+        self.Hs.true_e0[site], _ = qmlgen.get_H_eigval_eigvec_sparse(self.Hs.qml_Hs[site], 0)
 
         index = [site]
-        param = copy.copy(self.vqe_params0[index])
+        param, vqe_e = self.j_fit(jnp.array(self.vqe_params0[index]), terms, lr, n_epochs)
 
-        opt_init, opt_update, get_params = optimizers.adam(lr)
-        opt_state = opt_init(param)
+        self.vqe_e0[site] = vqe_e[0]
+        self.vqe_params0[site] = param[0]
+        self._params_version += 1
 
-        for _ in range(n_epochs):
-            param, opt_state = self._update(param, H, opt_state, opt_update, get_params)
+    def train_sites(self, lr: Number, n_epochs: int, sites: List[int]):
+        """
+        Minimize <psi|H|psi> for many independent sites at once,
+        each starting from its current parameters (vmap over the sites)
 
-        self.vqe_e0[site] = self.jv_compute_vqe_E(self.jv_q_vqe_state(param), H)
-        self.vqe_params0[site] = param
+        Parameters
+        ----------
+        lr : float
+            Learning rate to be multiplied in the circuit-gradient output
+        n_epochs : int
+            Total number of epochs for each learning
+        sites : List[int]
+            Indexes of the sites to train
+        """
+        sites = np.array(sites, dtype=int)
+
+        terms = self._get_terms(sites)
+        for site in sites:
+            self.Hs.true_e0[site], _ = qmlgen.get_H_eigval_eigvec_sparse(self.Hs.qml_Hs[site], 0)
+
+        # Every site is trained as in train_site, on a batch of one state
+        params = jnp.array(self.vqe_params0[sites])[:, None, :]
+        params, vqe_e = self.jv_fit(params, terms, lr, n_epochs)
+
+        self.vqe_e0[sites] = vqe_e[:, 0]
+        self.vqe_params0[sites] = params[:, 0]
+        self._params_version += 1
 
     def train(self, lr: Number, n_epochs: int, circuit: bool = False):
         """
@@ -303,16 +421,18 @@ class vqe:
         # The true GS energies will be computed during training
         # and not during initialization of the VQE since it
         # requires the diagonalization of many large matrices
+        # All the buffers are float32, as the device computation:
+        # no float64 -> float32 conversion at each call
         self.vqe_e0, self.vqe_params0, self.true_e0 = (
-            np.zeros((self.Hs.n_states,)),
-            np.zeros((self.Hs.n_states, self.n_params)),
-            np.zeros((self.Hs.n_states,)),
+            np.zeros((self.Hs.n_states,), dtype=np.single),
+            np.zeros((self.Hs.n_states, self.n_params), dtype=np.single),
+            np.zeros((self.Hs.n_states,), dtype=np.single),
         )
 
         try:
             self.Hs.true_e0
         except:
-            self.Hs.true_e0 = np.array([0.]*len(self.Hs.recycle_rule))
+            self.Hs.true_e0 = np.zeros((self.Hs.n_states,), dtype=np.single)
 
         progress = tqdm(self.Hs.recycle_rule, position=0, leave=True)
         # Site will follow the order of Hs.recycle rule:
@@ -337,19 +457,25 @@ class vqe:
             if site == 0:
                 epochs = 10 * n_epochs
                 # Random initial state
-                self.vqe_params0[site] = jnp.array(
-                    np.random.uniform(-np.pi, np.pi, size=(self.n_params))
+                self.key, subkey = jax.random.split(self.key)
+                self.vqe_params0[site] = jax.random.uniform(
+                    subkey, (self.n_params,), minval=-jnp.pi, maxval=jnp.pi
                 )
             else:
                 epochs = n_epochs
                 # Initial state is the final state of last site trained
-                self.vqe_params0[site] = copy.copy(self.vqe_params0[pred_site])
+                self.vqe_params0[site] = self.vqe_params0[pred_site]
 
             self.train_site(lr, epochs, int(site))
             pred_site = site  # Previous site for next training
 
     def train_refine(
-        self, lr: Number, n_epochs: int, acc_thr: Number, assist: bool = False
+        self,
+        lr: Number,
+        n_epochs: int,
+        acc_thr: Number,
+        assist: bool = False,
+        batch_size: int = 16,
     ):
         """
         Training only the sites that have an accuracy score worse (higher) than acc_thr
@@ -365,9 +491,28 @@ class vqe:
         assist : bool
             if True -> Each site that will be trained will start from the neighbouring site
             that has the better accuracy
+        batch_size : int
+            (if not assist) Number of sites trained at once, bounds the memory
+            of the stacked Pauli terms and of the states vmapped over the sites
         """
         progress = tqdm(range(self.Hs.n_states), position=0, leave=True)
 
+        if not assist:
+            # Without assist the sites do not depend on each other:
+            # train them in batches
+            sites = [
+                site for site in self.Hs.recycle_rule
+                if np.abs((self.vqe_e0[site] - self.true_e0[site]) / self.true_e0[site]) > acc_thr
+            ]
+            # Sites already accurate enough are skipped
+            progress.update(self.Hs.n_states - len(sites))
+            for start in range(0, len(sites), batch_size):
+                batch = sites[start : start + batch_size]
+                self.train_sites(lr, n_epochs, batch)
+                progress.update(len(batch))
+
+            return
+
         # Select the sites to train based on their accuracy score
         for site in self.Hs.recycle_rule:
             # Accuracy value of the given site
@@ -388,7 +533,7 @@ class vqe:
                     )
                     # Select the index of the neighbour with the best (lowest) accuracy score
                     best_neighbour = neighbours[np.argmin(neighbours_accuracies)]
-                    self.vqe_params0[site] = copy.copy(self.vqe_params0[best_neighbour])
+                    self.vqe_params0[site] = self.vqe_params0[best_neighbour]
                 # Start training the site
                 self.train_site(lr, n_epochs, int(site))
 
@@ -427,6 +572,8 @@ class vqe:
             if True plots the phase transition lines
         pe_line : bool
             if True plots Peshel Emery line
+        reuse_figure : bool
+            (IF ANNNI) if True and the figure is still open, only its data is updated
         """
         # Checks wether we are dealing with an isingchain (1D parameter space: mu)
         # or an annni model (2D parameter space: (kappa, h))
@@ -462,7 +609,7 @@ class vqe:
 
     def save(self, filename: str):
         """
-        Save main parameters of the VQE class to a local file.
+        Save main parameters of the VQE class to a local file (.npz archive).
         Parameters saved:
         > Hs class, vqe parameters, circuit function
 
@@ -474,23 +621,62 @@ class vqe:
 
         if not isinstance(filename, str):
             raise TypeError("Invalid name for file")
-            
-        things_to_save = [
-                self.Hs,
-                self.vqe_params0,
-                self.vqe_e0,
-                self.true_e0,
-                self.circuit_fun,
-            ]
 
+        # Arrays are stored as they are in a compressed .npz archive, the Hs class
+        # as its building function (by name), its arguments and its arrays, the
+        # circuit function by name. Only unknown functions are pickled
+        if _CIRCUITS.get(self.circuit_fun.__name__) is self.circuit_fun:
+            circuit = {"circuit_name": self.circuit_fun.__name__}
+        else:
+            circuit = {"circuit_fun": _to_bytes(self.circuit_fun)}
+
+        hs_name = f"{self.Hs.func.__module__}.{self.Hs.func.__name__}"
+        if _HS_FUNCS.get(hs_name) is self.Hs.func and hasattr(self.Hs, "_kwargs"):
+            Hs = {
+                "Hs_name": hs_name,
+                # numpy scalars are stored as python numbers
+                "Hs_kwargs": json.dumps(self.Hs._kwargs, default=lambda x: x.item()),
+            }
+            for name in _HS_ARRAYS:
+                if hasattr(self.Hs, name):
+                    Hs["Hs_" + name] = np.asarray(getattr(self.Hs, name))
+        else:
+            Hs = {"Hs": _to_bytes(self.Hs)}
+
+        # Passing a file object: np.savez would otherwise append .npz to filename
         with open(filename, "wb") as f:
-            pickle.dump(things_to_save, f)
+            np.savez_compressed(
+                f,
+                vqe_params0=np.asarray(self.vqe_params0),
+                vqe_e0=np.asarray(self.vqe_e0),
+                true_e0=np.asarray(self.true_e0),
+                **Hs,
+                **circuit,
+            )
+
+
+def _to_bytes(obj) -> np.ndarray:
+    """
+    Pickle an object into an array of bytes, to be stored in a .npz archive
+    """
+    return np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
+
+
+def _from_bytes(array: np.ndarray):
+    """
+    Inverse of _to_bytes
+    """
+    return pickle.loads(array.tobytes())
 
 
 def load_vqe(filename: str) -> vqe:
     """
     Load main parameters of a VQE class saved to a local file using vqe.save(filename)
 
+    Files of VQEs with the circuits and Hamiltonians of this package are read without
+    pickle. Custom circuit or building functions, and files saved with older versions,
+    are unpickled instead: as with any pickle, only load such files if you trust them
+
     Parameters
     ----------
     filename : str
@@ -504,29 +690,49 @@ def load_vqe(filename: str) -> vqe:
     if not isinstance(filename, str):
         raise TypeError("Invalid name for file")
 
-    with open(filename, "rb") as f:
-        things_to_load = pickle.load(f)
+    if zipfile.is_zipfile(filename):
+        with np.load(filename, allow_pickle=False) as data:
+            if "Hs_name" in data:
+                Hs = hamiltonians.hamiltonian(
+                    _HS_FUNCS[str(data["Hs_name"])], **json.loads(str(data["Hs_kwargs"]))
+                )
+                for name in _HS_ARRAYS:
+                    if "Hs_" + name in data:
+                        setattr(Hs, name, data["Hs_" + name])
+            else:
+                Hs = _from_bytes(data["Hs"])
+            if "circuit_name" in data:
+                circuit_fun = _CIRCUITS[str(data["circuit_name"])]
+            else:
+                circuit_fun = _from_bytes(data["circuit_fun"])
+            vqe_params, vqe_e, true_e = data["vqe_params0"], data["vqe_e0"], data["true_e0"]
 
-    if len(things_to_load) == 5:
-        Hs, vqe_params, vqe_e, true_e, circuit_fun = things_to_load
         loaded_vqe = vqe(Hs, circuit_fun)
     else:
-        (
-            Hs,
-            vqe_params,
-            vqe_e,
-            true_e,
-            vqe_params1,
-            vqe_e1,
-            true_e1,
-            circuit_fun,
-        ) = things_to_load
-        loaded_vqe = vqe(Hs, circuit_fun)
-
-        warnings.warn("Outdated VQE: VQD parameters loaded")
-        loaded_vqe.vqe_params1 = vqe_params1
-        loaded_vqe.vqe_e1 = vqe_e1
-        loaded_vqe.true_e1 = true_e1
+        # Files saved with older versions are single pickles
+        with open(filename, "rb") as f:
+            things_to_load = pickle.load(f)
+
+        if len(things_to_load) == 5:
+            Hs, vqe_params, vqe_e, true_e, circuit_fun = things_to_load
+            loaded_vqe = vqe(Hs, circuit_fun)
+        else:
+            (
+                Hs,
+                vqe_params,
+                vqe_e,
+                true_e,
+                vqe_params1,
+                vqe_e1,
+                true_e1,
+                circuit_fun,
+            ) = things_to_load
+            loaded_vqe = vqe(Hs, circuit_fun)
+
+            warnings.warn("Outdated VQE: VQD parameters loaded")
+            loaded_vqe.vqe_params1 = vqe_params1
+            loaded_vqe.vqe_e1 = vqe_e1
+            loaded_vqe.true_e1 = true_e1
 
     loaded_vqe.vqe_params0 = vqe_params
     loaded_vqe.vqe_e0 = vqe_e